@@ -0,0 +1,592 @@
+""" benchmarks: micro-benchmarks for shapelytools and pandashp
+
+Each benchmark function runs an operation on synthetic data in two variants
+and returns a list of dicts (one per variant and size) with the measured
+runtime, so that results can be compared, e.g. via pandas.DataFrame(results).
+Both variants must return identical results, otherwise AssertionError is
+raised.
+
+Function run_suite measures how the main functions of shapelytools, pandashp
+and skeletrontools scale with data size. It runs each case (see SUITE) in a
+fresh process on seeded synthetic road networks and building polygons,
+records runtime and peak memory and writes them to a JSON file. Use
+compare_results to compare two such files, e.g. from different commits.
+
+Usage:
+    python benchmarks.py
+    python benchmarks.py suite results.json
+    # or
+    import benchmarks
+    results = benchmarks.benchmark_prepared(sizes=[100, 400])
+    benchmarks.run_suite(sizes=[1000, 10000], output='after.json')
+    print(benchmarks.compare_results('before.json', 'after.json'))
+
+"""
+
+import datetime
+import importlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+import pandas as pd
+import pandashp
+import shapelytools
+from shapely.geometry import LineString, Polygon
+
+try:
+    import resource
+except ImportError: # resource is only available on Unix platforms
+    resource = None
+
+
+def grid_lines(size, spacing=100.0, noise=0.0, gaps=0, seed=0):
+    """Create a list of LineStrings forming a square grid of street segments.
+
+    Args:
+        size: number of grid cells per side
+        spacing: optional edge length of a grid cell
+        noise: optional maximum random displacement of vertices
+        gaps: optional number of lines whose end is pulled back by up to
+              5 % of spacing, leaving a near-miss endpoint
+        seed: optional seed for the random displacement
+
+    Returns:
+        list of 2 * size * (size + 1) LineStrings of one grid cell length each
+    """
+    rng = random.Random(seed)
+
+    def vertex(i, j):
+        return (i * spacing + rng.uniform(-noise, noise),
+                j * spacing + rng.uniform(-noise, noise))
+
+    vertices = dict(((i, j), vertex(i, j))
+                    for i in range(size + 1) for j in range(size + 1))
+    lines = []
+    for i in range(size + 1):
+        for j in range(size):
+            lines.append(LineString([vertices[i, j], vertices[i, j + 1]]))
+            lines.append(LineString([vertices[j, i], vertices[j + 1, i]]))
+
+    for k in rng.sample(range(len(lines)), gaps):
+        line = lines[k]
+        lines[k] = LineString([line.coords[0], line.interpolate(
+            line.length - rng.uniform(0.01, 0.05) * spacing).coords[0]])
+    return lines
+
+
+def road_network(num_lines, spacing=100.0, noise=0.1, dangles=0.05,
+                 gaps=0.05, seed=0):
+    """Create a seeded synthetic road network of roughly num_lines lines.
+
+    Starts from a square grid of street segments (see grid_lines) with
+    randomly displaced crossings, then adds dangling dead ends and pulls
+    back some line ends to leave near-miss endpoints.
+
+    Args:
+        num_lines: approximate number of LineStrings to create
+        spacing: optional edge length of a grid cell
+        noise: optional maximum displacement of crossings, relative to
+               spacing
+        dangles: optional share of lines to add as dead ends
+        gaps: optional share of lines with a near-miss endpoint
+        seed: optional seed for all random choices
+
+    Returns:
+        list of LineStrings
+    """
+    num_grid = max(int(round(num_lines / (1.0 + dangles))), 4)
+    size = max(int(math.ceil((-1 + math.sqrt(1 + 2 * num_grid)) / 2)), 1)
+    lines = grid_lines(size, spacing=spacing, noise=noise * spacing,
+                       gaps=int(gaps * num_grid), seed=seed)
+
+    # dead ends start at the middle of a street and point away from it; the
+    # start becomes a vertex of the street, so that it lies exactly on it
+    rng = random.Random(seed + 1)
+    for k in rng.sample(range(len(lines)), min(int(dangles * num_grid),
+                                                len(lines))):
+        line = lines[k]
+        (x0, y0), (x1, y1) = line.coords[0], line.coords[-1]
+        length = rng.uniform(0.1, 0.4) * spacing
+        dx, dy = (x1 - x0) / line.length, (y1 - y0) / line.length
+        side = rng.choice((-1, 1))
+        start = ((x0 + x1) / 2, (y0 + y1) / 2)
+        lines[k] = LineString([(x0, y0), start, (x1, y1)])
+        lines.append(LineString([start, (start[0] - side * dy * length,
+                                         start[1] + side * dx * length)]))
+    return lines
+
+
+def building_polygons(num_polygons, spacing=100.0, seed=0):
+    """Create seeded, randomly rotated rectangular buildings.
+
+    Buildings are placed in the blocks of a grid like the one of
+    road_network, so that they do not overlap its (noisy) grid streets of
+    the same spacing; dead ends may run into them, though.
+
+    Args:
+        num_polygons: number of Polygons to create
+        spacing: optional block size
+        seed: optional seed for all random choices
+
+    Returns:
+        list of Polygons
+    """
+    rng = random.Random(seed)
+    per_block = 4
+    blocks = max(int(math.ceil(math.sqrt(num_polygons / float(per_block)))), 1)
+    quarter = spacing / 4.0
+
+    polygons = []
+    for k in range(num_polygons):
+        block, slot = divmod(k, per_block)
+        i, j = divmod(block, blocks)
+        # block corner plus center of the slot's quarter of the block
+        cx = i * spacing + (1 + 2 * (slot % 2)) * quarter
+        cy = j * spacing + (1 + 2 * (slot // 2)) * quarter
+        width = rng.uniform(0.15, 0.4) * quarter
+        depth = rng.uniform(0.15, 0.4) * quarter
+        angle = rng.uniform(0, math.pi)
+        c, s = math.cos(angle), math.sin(angle)
+        polygons.append(Polygon([(cx + c * u - s * v, cy + s * u + c * v)
+                                 for u, v in [(-width, -depth), (width, -depth),
+                                              (width, depth), (-width, depth)]]))
+    return polygons
+
+
+def random_lines(num_lines, extent=10, max_vertices=4, seed=0):
+    """Create seeded random LineStrings with integer vertex coordinates.
+
+    Vertices on a small integer grid produce many degenerate cases, e.g.
+    collinear overlaps, T-junctions and crossings at shared vertices.
+
+    Args:
+        num_lines: number of LineStrings to create
+        extent: optional number of distinct coordinate values per axis
+        max_vertices: optional maximum number of vertices per line
+        seed: optional seed for all random choices
+
+    Returns:
+        list of LineStrings (of non-zero length)
+    """
+    rng = random.Random(seed)
+    lines = []
+    while len(lines) < num_lines:
+        line = LineString([(rng.randrange(extent), rng.randrange(extent))
+                           for _ in range(rng.randint(2, max_vertices))])
+        if line.length > 0:
+            lines.append(line)
+    return lines
+
+
+def time_call(func, repeat=3):
+    """Return tuple (result, seconds) of func() with minimum of repeat runs."""
+    result = []
+
+    def run():
+        result.append(func())
+
+    seconds = min(timeit.repeat(run, number=1, repeat=repeat))
+    return result[-1], seconds
+
+
+def _compare_variants(name, size, variants):
+    """Time named variants (name, func) and check their results are equal."""
+    results = []
+    reference = None
+    for variant, func in variants:
+        result, seconds = time_call(func)
+        if reference is None:
+            reference = result
+        elif result != reference:
+            raise AssertionError('{} ({}): results differ'.format(name, variant))
+        results.append({'function': name, 'variant': variant,
+                        'size': size, 'seconds': seconds})
+    return results
+
+
+def benchmark_prepared(sizes=(10, 20, 40)):
+    """Compare topology functions with and without prepared geometries.
+
+    Args:
+        sizes: optional list of grid sizes (see grid_lines)
+
+    Returns:
+        list of dicts with keys function, variant, size and seconds
+    """
+    results = []
+    for size in sizes:
+        lines = grid_lines(size, noise=5.0, gaps=size)
+        middle = lines[len(lines) // 2]
+        vertices = pd.DataFrame({'geometry':
+            shapelytools.endpoints_from_lines(lines)})
+
+        def neighbors(prepared):
+            return lambda: shapelytools.neighbors(lines, middle, prepared)
+
+        def isolated(prepared):
+            return lambda: [p.coords[0] for p in
+                shapelytools.find_isolated_endpoints(lines, prepared)]
+
+        def snappy(prepared):
+            return lambda: [list(line.coords) for line in
+                shapelytools.snappy_endings(lines, 10.0, prepared)]
+
+        def match(prepared):
+            def run():
+                edges = pd.DataFrame({'geometry': lines})
+                pandashp.match_vertices_and_edges(vertices, edges,
+                                                  prepared=prepared)
+                return edges[['Vertex1', 'Vertex2']].values.tolist()
+            return run
+
+        for name, variant in [('neighbors', neighbors),
+                              ('find_isolated_endpoints', isolated),
+                              ('snappy_endings', snappy),
+                              ('match_vertices_and_edges', match)]:
+            results.extend(_compare_variants(name, size, [
+                ('plain', variant(False)),
+                ('prepared', variant(shapelytools.PreparedCache()))]))
+    return results
+
+
+def benchmark_node_and_merge_grid(cell_sizes=(1, 3, 4.5), trials=400):
+    """Compare node_and_merge_grid with node_and_merge on random networks.
+
+    Each trial uses a different seed for random_lines, so this doubles as a
+    randomized check that the grid-partitioned result is identical.
+
+    Args:
+        cell_sizes: optional list of grid cell sizes
+        trials: optional number of random networks per cell size
+
+    Returns:
+        list of dicts with keys function, variant, size and seconds
+    """
+    networks = [random_lines(random.Random(seed).randint(2, 12), seed=seed)
+                for seed in range(trials)]
+
+    def run(node_and_merge):
+        return lambda: [[list(line.coords) for line in node_and_merge(lines)]
+                        for lines in networks]
+
+    results = []
+    for cell_size in cell_sizes:
+        results.extend(_compare_variants('node_and_merge', cell_size, [
+            ('monolithic', run(shapelytools.node_and_merge)),
+            ('grid', run(lambda lines: shapelytools.node_and_merge_grid(
+                lines, cell_size)))]))
+    return results
+
+
+def benchmark_line_index(trials=400):
+    """Compare the list and LineIndex variants of the cleaning functions.
+
+    Each trial uses a different seed for random_lines, so this doubles as a
+    randomized check that both variants return identical lines.
+
+    Args:
+        trials: optional number of random networks
+
+    Returns:
+        list of dicts with keys function, variant, size and seconds
+    """
+    networks = [random_lines(random.Random(seed).randint(2, 12), seed=seed)
+                for seed in range(trials)]
+
+    def run(func, as_index):
+        def clean(lines):
+            if as_index:
+                lines = shapelytools.LineIndex(lines)
+            return [list(line.coords) for line in func(lines)]
+        return lambda: [clean(lines) for lines in networks]
+
+    results = []
+    for name, func in [
+            ('snappy_endings',
+             lambda lines: shapelytools.snappy_endings(lines, 3.0)),
+            ('prune_short_lines',
+             lambda lines: shapelytools.prune_short_lines(lines, 2.0)),
+            ('find_isolated_endpoints',
+             lambda lines: shapelytools.find_isolated_endpoints(lines))]:
+        results.extend(_compare_variants(name, trials, [
+            ('list', run(func, False)),
+            ('LineIndex', run(func, True))]))
+    return results
+
+
+# seconds; shapelytools imports shapely eagerly, all others defer their
+# heavy dependencies (see lazyimports)
+DEFAULT_IMPORT_BUDGETS = {
+    'graphtools': 0.05,
+    'instrumentation': 0.05,
+    'lazyimports': 0.05,
+    'pandashp': 0.05,
+    'pandaspyomo': 0.05,
+    'pyomotools': 0.05,
+    'shapelytools': 0.5,
+    'shptools': 0.05,
+    'skeletrontools': 0.05}
+
+
+def benchmark_import_time(budgets=None, repeat=3):
+    """Measure how long importing each module takes in a fresh interpreter.
+
+    Each import runs in a separate Python process, so that no module is
+    cached already. The interpreter start-up itself is measured separately
+    and subtracted.
+
+    Args:
+        budgets: optional dict of module name to maximum import time in
+                 seconds; defaults to DEFAULT_IMPORT_BUDGETS
+        repeat: optional number of runs, the minimum time is reported
+
+    Returns:
+        list of dicts with keys module, seconds and budget
+
+    Raises:
+        AssertionError if a module takes longer than its budget
+    """
+    if budgets is None:
+        budgets = DEFAULT_IMPORT_BUDGETS
+    directory = os.path.dirname(os.path.abspath(__file__))
+    script = ('import sys, time; sys.path.insert(0, {!r}); '
+              't = time.time(); {}; print(time.time() - t)')
+
+    def measure(statement):
+        return min(float(subprocess.check_output(
+            [sys.executable, '-c', script.format(directory, statement)]))
+            for _ in range(repeat))
+
+    baseline = measure('pass')
+    results = []
+    for module in sorted(budgets):
+        seconds = max(measure('import ' + module) - baseline, 0.0)
+        results.append({'module': module, 'seconds': seconds,
+                        'budget': budgets[module]})
+        if seconds > budgets[module]:
+            raise AssertionError('import {} took {:.3f} s (budget {:.3f} s)'
+                                 .format(module, seconds, budgets[module]))
+    return results
+
+
+class CaseSkipped(Exception):
+    """Raised by the setup of a benchmark case that cannot run here."""
+
+
+def _require(module):
+    """Import module, raise CaseSkipped if it is not installed."""
+    try:
+        importlib.import_module(module)
+    except ImportError:
+        raise CaseSkipped('module {} is not installed'.format(module))
+
+
+def _setup_snappy_endings(size, seed):
+    lines = road_network(size, seed=seed)
+    return lambda: shapelytools.snappy_endings(lines, max_distance=10.0)
+
+
+def _setup_prune_short_lines(size, seed):
+    lines = road_network(size, seed=seed)
+    return lambda: shapelytools.prune_short_lines(lines, min_length=30.0)
+
+
+def _setup_find_isolated_endpoints(size, seed):
+    lines = road_network(size, seed=seed)
+    return lambda: shapelytools.find_isolated_endpoints(lines)
+
+
+def _setup_match_vertices_and_edges(size, seed):
+    lines = road_network(size, seed=seed)
+    vertices = pd.DataFrame({'geometry': shapelytools.endpoints_from_lines(lines)})
+    edges = pd.DataFrame({'geometry': lines})
+    return lambda: pandashp.match_vertices_and_edges(vertices, edges)
+
+
+def _setup_find_closest_edge(size, seed):
+    edges = pd.DataFrame({'geometry': road_network(size, seed=seed)})
+    edges['edge'] = range(len(edges))
+    polygons = pd.DataFrame({'geometry': building_polygons(size, seed=seed)})
+    return lambda: pandashp.find_closest_edge(polygons, edges, to_attr='edge')
+
+
+def _setup_shp_round_trip(size, seed):
+    _require('shapefile')
+    df = pd.DataFrame({'geometry': road_network(size, seed=seed)})
+    df['length'] = [line.length for line in df.geometry]
+
+    def run():
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'roads')
+            pandashp.write_shp(filename, df)
+            return pandashp.read_shp(filename)
+        finally:
+            shutil.rmtree(directory)
+    return run
+
+
+def _setup_skeletonize(size, seed):
+    _require('Skeletron')
+    import skeletrontools
+    roads = pd.DataFrame({'geometry': road_network(size, seed=seed)})
+    return lambda: skeletrontools.skeletonize(roads)
+
+
+# benchmark cases of run_suite: name -> setup(size, seed) returning the
+# function to time (or raising CaseSkipped)
+SUITE = {
+    'snappy_endings': _setup_snappy_endings,
+    'prune_short_lines': _setup_prune_short_lines,
+    'find_isolated_endpoints': _setup_find_isolated_endpoints,
+    'match_vertices_and_edges': _setup_match_vertices_and_edges,
+    'find_closest_edge': _setup_find_closest_edge,
+    'shp_round_trip': _setup_shp_round_trip,
+    'skeletonize': _setup_skeletonize}
+
+
+def _max_rss():
+    """Return peak resident memory of this process in MB (None if unknown)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kB on Linux, but in bytes on Mac OS X
+    return peak / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+
+def _run_case(args):
+    """Set up and time one benchmark case (run in a fresh process)."""
+    name, size, seed, repeat = args
+    func = SUITE[name](size, seed)
+    memory_before = _max_rss()
+    _, seconds = time_call(func, repeat=repeat)
+    peak_memory = _max_rss()
+    memory_increase = None
+    if peak_memory is not None:
+        memory_increase = peak_memory - memory_before
+    return seconds, peak_memory, memory_increase
+
+
+def _git_commit():
+    """Return current git commit hash of this module's directory, or None."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(sizes=(1000, 10000, 100000, 1000000), cases=None,
+              output='benchmark_results.json', repeat=1, seed=0,
+              timeout=600):
+    """Time benchmark cases for growing data sizes.
+
+    Each case and size runs in a fresh process, so that the peak memory is
+    measured for that case alone. Slow cases are stopped after timeout
+    seconds; bigger sizes of a case are skipped after a timeout or error.
+    Cases whose dependencies are not installed are skipped with a reason.
+
+    Args:
+        sizes: optional list of data sizes (number of lines or polygons)
+        cases: optional list of case names (default: all of SUITE)
+        output: optional JSON file name to write results to (None: don't)
+        repeat: optional number of runs, the minimum time is reported
+        seed: optional seed for the data generators
+        timeout: optional maximum seconds per case and size
+
+    Returns:
+        list of dicts with keys case, size, status ('ok', 'timeout',
+        'error' or 'skipped'), seconds, peak_memory and memory_increase
+        (both in MB, None if unknown), plus error or reason (for skipped
+        cases) if applicable
+    """
+    if cases is None:
+        cases = sorted(SUITE)
+
+    results = []
+    for name in cases:
+        failed = False
+        for size in sizes:
+            size = int(size)
+            result = {'case': name, 'size': size, 'status': 'skipped',
+                      'seconds': None, 'peak_memory': None,
+                      'memory_increase': None}
+            results.append(result)
+            if failed:
+                continue
+
+            pool = multiprocessing.Pool(1)
+            try:
+                seconds, peak_memory, memory_increase = pool.apply_async(
+                    _run_case, [(name, size, seed, repeat)]).get(timeout)
+                result.update(status='ok', seconds=seconds,
+                              peak_memory=peak_memory,
+                              memory_increase=memory_increase)
+            except multiprocessing.TimeoutError:
+                result['status'], failed = 'timeout', True
+            except CaseSkipped as e:
+                result['reason'], failed = str(e), True
+                sys.stderr.write('skipped {}: {}\n'.format(name, e))
+            except Exception as e:
+                result['status'], failed = 'error', True
+                result['error'] = '{}: {}'.format(type(e).__name__, e)
+            finally:
+                pool.terminate()
+                pool.join()
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({'commit': _git_commit(),
+                       'date': datetime.datetime.now().isoformat(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'results': results}, f, indent=2)
+    return results
+
+
+def compare_results(before, after):
+    """Compare two result files written by run_suite.
+
+    Args:
+        before: file name of the reference results
+        after: file name of the new results
+
+    Returns:
+        DataFrame indexed by (case, size) with columns seconds_before,
+        seconds_after, seconds_ratio, memory_before, memory_after and
+        memory_ratio (ratios > 1 mean after is slower/bigger)
+    """
+    frames = []
+    for filename, suffix in ((before, '_before'), (after, '_after')):
+        with open(filename) as f:
+            df = pd.DataFrame(json.load(f)['results'])
+        df = df.set_index(['case', 'size'])[['seconds', 'peak_memory']]
+        df.columns = ['seconds' + suffix, 'memory' + suffix]
+        frames.append(df)
+
+    df = frames[0].join(frames[1], how='outer')
+    df['seconds_ratio'] = df['seconds_after'] / df['seconds_before']
+    df['memory_ratio'] = df['memory_after'] / df['memory_before']
+    return df[['seconds_before', 'seconds_after', 'seconds_ratio',
+               'memory_before', 'memory_after', 'memory_ratio']]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        output = sys.argv[2] if len(sys.argv) > 2 else 'benchmark_results.json'
+        print(pd.DataFrame(run_suite(output=output)).to_string(index=False))
+    else:
+        print(pd.DataFrame(benchmark_prepared()).to_string(index=False))
+        print(pd.DataFrame(benchmark_node_and_merge_grid()).to_string(
+            index=False))
+        print(pd.DataFrame(benchmark_line_index()).to_string(index=False))
+        print(pd.DataFrame(benchmark_import_time()).to_string(index=False))
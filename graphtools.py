@@ -0,0 +1,289 @@
+""" graphtools: compact graphs from pandashp vertex/edge DataFrames
+
+Once pandashp.match_vertices_and_edges has added the columns Vertex1 and
+Vertex2 to a DataFrame of edges, function from_edges turns it into a CSRGraph.
+Its adjacency is stored in compressed sparse row (CSR) form in a few NumPy
+arrays, i.e. some 30 bytes per edge instead of roughly 1 KB per edge for a
+networkx dict-of-dicts. Edge lengths and other numeric edge attributes are
+kept as plain arrays, too.
+
+Usage:
+    import pandashp as pdshp
+    import graphtools as gt
+    vertices = pdshp.read_shp('vertices')
+    edges = pdshp.read_shp('edges')
+    pdshp.match_vertices_and_edges(vertices, edges)
+    graph = gt.from_edges(edges, vertices, attributes=['speed'])
+    distance, path, path_edges = graph.shortest_path(3, 42)
+    components = graph.connected_components()
+
+"""
+
+import heapq
+from lazyimports import lazy_import
+
+# heavy dependencies are only imported when first used
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+class CSRGraph(object):
+    """Undirected multigraph with adjacency in compressed sparse row form.
+
+    Vertices and edges are identified by the labels they had in the
+    DataFrames the graph was built from (see from_edges). Internally, they
+    are numbered by position. The neighbors of the vertex at position k are
+    indices[indptr[k]:indptr[k+1]], connected by the edges at positions
+    edge_of[indptr[k]:indptr[k+1]].
+
+    Attributes:
+        vertex_ids: pandas Index of vertex labels
+        edge_ids: pandas Index of edge labels
+        indptr: integer array of length num_vertices + 1
+        indices: integer array of neighbor vertex positions
+        edge_of: integer array of edge positions for each entry of indices
+        attributes: dict of numeric arrays (one value per edge), containing
+                    at least 'length'
+    """
+
+    def __init__(self, vertex_ids, edge_ids, source, target, attributes):
+        """Create graph from vertex positions of edge endpoints.
+
+        Args:
+            vertex_ids: sequence of vertex labels
+            edge_ids: sequence of edge labels
+            source, target: integer arrays of vertex positions of the edges
+            attributes: dict of edge attribute arrays (incl. 'length')
+        """
+        self.vertex_ids = pd.Index(vertex_ids)
+        self.edge_ids = pd.Index(edge_ids)
+        self.attributes = attributes
+
+        num_vertices, num_edges = len(self.vertex_ids), len(self.edge_ids)
+        dtype = np.int32 if max(num_vertices, num_edges) < 2**31 else np.int64
+        source = np.asarray(source, dtype=dtype)
+        target = np.asarray(target, dtype=dtype)
+
+        # each undirected edge is stored in the adjacency of both endpoints
+        ends = np.concatenate([source, target])
+        order = np.argsort(ends, kind='mergesort')
+        self.indices = np.concatenate([target, source])[order]
+        self.edge_of = np.concatenate([np.arange(num_edges, dtype=dtype)] * 2)[order]
+        self.indptr = np.zeros(num_vertices + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(np.bincount(ends, minlength=num_vertices))
+        self.source, self.target = source, target
+
+    def __len__(self):
+        return len(self.vertex_ids)
+
+    def _positions(self, vertices):
+        """Return vertex positions for vertex labels, raise if unknown."""
+        positions = self.vertex_ids.get_indexer(np.atleast_1d(vertices))
+        if (positions < 0).any():
+            raise KeyError('Unknown vertex id(s).')
+        return positions
+
+    def _weights(self, weight):
+        """Return per-edge weight array for attribute name weight."""
+        weights = np.asarray(self.attributes[weight], dtype=float)
+        if (weights < 0).any():
+            raise ValueError("Negative values in edge attribute '{}'.".format(weight))
+        return weights
+
+    def degree(self):
+        """Return Series of number of edge ends per vertex (loops count 2)."""
+        return pd.Series(np.diff(self.indptr), index=self.vertex_ids)
+
+    def neighbors(self, vertex):
+        """Return list of vertex labels adjacent to vertex."""
+        k = self._positions(vertex)[0]
+        return list(self.vertex_ids[self.indices[self.indptr[k]:self.indptr[k + 1]]])
+
+    def connected_components(self):
+        """Label vertices by connected component.
+
+        Uses vectorized label propagation with pointer jumping: each vertex
+        points to a representative, and representatives of adjacent vertices
+        are hooked onto the smaller one until all edges agree.
+
+        Returns:
+            Series of component numbers 0, 1, ... indexed by vertex labels;
+            components are numbered in order of their first vertex
+        """
+        labels = np.arange(len(self.vertex_ids))
+        source, target = self.source, self.target
+        while True:
+            lowest = np.minimum(labels[source], labels[target])
+            hooked = labels.copy()
+            np.minimum.at(hooked, labels[source], lowest)
+            np.minimum.at(hooked, labels[target], lowest)
+
+            # pointer jumping: let every vertex point to its representative
+            while True:
+                jumped = hooked[hooked]
+                if (jumped == hooked).all():
+                    break
+                hooked = jumped
+
+            if (hooked == labels).all():
+                break
+            labels = hooked
+
+        _, components = np.unique(labels, return_inverse=True)
+        return pd.Series(components.ravel(), index=self.vertex_ids)
+
+    def dijkstra(self, sources, targets=None, weight='length', cutoff=None):
+        """Find shortest path distances from one or several source vertices.
+
+        Neighbors of each settled vertex are relaxed in one vectorized step.
+        The search stops as soon as all targets are settled, or all vertices
+        within distance cutoff are found.
+
+        Args:
+            sources: a vertex label or list of vertex labels
+            targets: optional vertex label(s) at which the search may stop
+            weight: name of edge attribute to use as edge length
+            cutoff: optional maximum distance to search
+
+        Returns:
+            DataFrame indexed by the labels of all settled vertices, with
+            columns distance, predecessor (vertex label, NaN for sources)
+            and edge (label of the edge from predecessor)
+        """
+        weights = self._weights(weight)
+        num_vertices = len(self.vertex_ids)
+        dist = np.full(num_vertices, np.inf)
+        pred = np.full(num_vertices, -1, dtype=np.int64)
+        pred_edge = np.full(num_vertices, -1, dtype=np.int64)
+        settled = np.zeros(num_vertices, dtype=bool)
+
+        remaining = set()
+        if targets is not None:
+            remaining = set(self._positions(targets).tolist())
+
+        heap = []
+        for s in self._positions(sources).tolist():
+            dist[s] = 0
+            heap.append((0.0, s))
+        heapq.heapify(heap)
+
+        order = []
+        while heap:
+            d, u = heapq.heappop(heap)
+            if settled[u] or d > dist[u]:
+                continue
+            if cutoff is not None and d > cutoff:
+                break
+            settled[u] = True
+            order.append(u)
+
+            if targets is not None:
+                remaining.discard(u)
+                if not remaining:
+                    break
+
+            # relax all neighbors at once
+            start, end = self.indptr[u], self.indptr[u + 1]
+            neighbors = self.indices[start:end]
+            edges = self.edge_of[start:end]
+            new_dist = d + weights[edges]
+            better = new_dist < dist[neighbors]
+            if not better.any():
+                continue
+            neighbors, edges = neighbors[better], edges[better]
+            new_dist = new_dist[better]
+            # parallel edges: keep the shortest one per neighbor
+            if len(neighbors) > 1:
+                shortest = np.lexsort((new_dist, neighbors))
+                first = np.ones(len(shortest), dtype=bool)
+                first[1:] = neighbors[shortest][1:] != neighbors[shortest][:-1]
+                shortest = shortest[first]
+                neighbors = neighbors[shortest]
+                edges, new_dist = edges[shortest], new_dist[shortest]
+            dist[neighbors] = new_dist
+            pred[neighbors] = u
+            pred_edge[neighbors] = edges
+            for v, dv in zip(neighbors.tolist(), new_dist.tolist()):
+                heapq.heappush(heap, (dv, v))
+
+        order = np.array(order, dtype=np.int64)
+        has_pred = pred[order] >= 0
+        predecessor = pd.Series(np.nan, index=range(len(order)), dtype=object)
+        predecessor[has_pred] = self.vertex_ids[pred[order][has_pred]]
+        edge = pd.Series(np.nan, index=range(len(order)), dtype=object)
+        edge[has_pred] = self.edge_ids[pred_edge[order][has_pred]]
+        return pd.DataFrame({'distance': dist[order],
+                             'predecessor': predecessor.values,
+                             'edge': edge.values},
+                            index=self.vertex_ids[order],
+                            columns=['distance', 'predecessor', 'edge'])
+
+    def shortest_path(self, source, target, weight='length'):
+        """Find a shortest path between two vertices.
+
+        Args:
+            source: label of start vertex
+            target: label of end vertex
+            weight: name of edge attribute to use as edge length
+
+        Returns:
+            Tuple (distance, vertices, edges) of the path length, the list
+            of vertex labels from source to target and the list of edge
+            labels along the path
+
+        Raises:
+            ValueError if target is not reachable from source
+        """
+        result = self.dijkstra(source, targets=target, weight=weight)
+        if target not in result.index:
+            raise ValueError('No path between {} and {}.'.format(source, target))
+
+        vertices, edges = [target], []
+        while vertices[-1] != source:
+            row = result.loc[vertices[-1]]
+            vertices.append(row['predecessor'])
+            edges.append(row['edge'])
+        return (result.loc[target, 'distance'],
+                vertices[::-1], edges[::-1])
+
+
+def from_edges(edges, vertices=None, vertex_cols=('Vertex1', 'Vertex2'),
+               attributes=()):
+    """Create a CSRGraph from a DataFrame of edges.
+
+    Args:
+        edges: pandas DataFrame with vertex ID columns (see
+               pandashp.match_vertices_and_edges); if it has a geometry
+               column, its lengths are used as edge attribute 'length',
+               otherwise each edge has length 1
+        vertices: optional DataFrame whose index are the vertex IDs; if
+                  omitted, all IDs occurring in vertex_cols are used
+        vertex_cols: tuple of 2 column names with the edges' vertex IDs
+        attributes: list of numeric edge columns to copy into the graph
+
+    Returns:
+        a CSRGraph
+    """
+    first = edges[vertex_cols[0]].values
+    second = edges[vertex_cols[1]].values
+
+    if vertices is not None:
+        vertex_ids = vertices.index
+    else:
+        vertex_ids = pd.Index(np.unique(np.concatenate([first, second])))
+
+    source = vertex_ids.get_indexer(first)
+    target = vertex_ids.get_indexer(second)
+    if (source < 0).any() or (target < 0).any():
+        raise ValueError('Edges reference vertex IDs missing in vertices.')
+
+    edge_attributes = {}
+    if 'geometry' in edges.columns:
+        edge_attributes['length'] = np.array(
+            [line.length for line in edges['geometry']], dtype=float)
+    else:
+        edge_attributes['length'] = np.ones(len(edges))
+    for column in attributes:
+        edge_attributes[column] = edges[column].values
+
+    return CSRGraph(vertex_ids, edges.index, source, target, edge_attributes)
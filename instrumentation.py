@@ -0,0 +1,249 @@
+""" instrumentation: count calls, time and shapely operations per function
+
+Most of the runtime of shapelytools and pandashp is spent in shapely calls
+within nested loops. When enabled, this module wraps the public functions of
+all registered modules (shapelytools and pandashp register themselves) and
+the shapely geometry methods, and records per function:
+
+    calls          number of calls
+    seconds        wall time (inclusive of nested calls)
+    predicates     binary predicates and distance measures (touches,
+                   intersects, distance, ...), incl. prepared geometries
+    operations     operations returning new geometries (intersection,
+                   buffer, centroid, ...)
+    constructions  geometries created from coordinates (Point(...), ...)
+
+Counts are inclusive, i.e. a shapely call within snappy_endings, which in
+turn calls find_isolated_endpoints, counts for both functions. Calls within
+worker processes of a process pool are not recorded. When disabled, all
+wrappers are removed again, so there is no overhead at all.
+
+Usage:
+    import instrumentation
+    import shapelytools
+    with instrumentation.instrumented():
+        shapelytools.snappy_endings(lines, 10)
+    print(instrumentation.report_frame())
+
+    # or, for a whole script without changing it; a value ending in .json
+    # is a file name to write the report to, otherwise it is printed
+    PYTHON_TOOLS_INSTRUMENT=report.json python script.py
+
+"""
+
+import functools
+import os
+import sys
+import time
+from contextlib import contextmanager
+from lazyimports import lazy_import
+
+# modules that are only needed once instrumentation is enabled; shapelytools
+# and pandashp import this module, so it must not slow down their import
+inspect = lazy_import('inspect')
+json = lazy_import('json')
+pd = lazy_import('pandas')
+
+ENVIRONMENT_VARIABLE = 'PYTHON_TOOLS_INSTRUMENT'
+
+PREDICATES = ('contains', 'contains_properly', 'covers', 'crosses',
+              'disjoint', 'equals', 'equals_exact', 'almost_equals',
+              'intersects', 'overlaps', 'touches', 'within', 'relate',
+              'distance', 'hausdorff_distance', 'project')
+OPERATIONS = ('intersection', 'union', 'difference', 'symmetric_difference',
+              'buffer', 'simplify', 'interpolate', 'centroid',
+              'representative_point', 'convex_hull', 'envelope', 'boundary')
+GEOMETRY_CLASSES = ('Point', 'LineString', 'LinearRing', 'Polygon',
+                    'MultiPoint', 'MultiLineString', 'MultiPolygon',
+                    'GeometryCollection')
+COUNTERS = ('calls', 'seconds', 'predicates', 'operations', 'constructions')
+
+_MISSING = object()
+_enabled = [False]
+_registered = []
+_patches = []
+_records = {}
+_active = {}
+_in_shapely = [False]
+
+
+def is_enabled():
+    """Return True if instrumentation is currently enabled."""
+    return _enabled[0]
+
+
+def register(module_name):
+    """Register a module whose public functions are to be instrumented.
+
+    Args:
+        module_name: name of an imported module, usually __name__
+    """
+    module = sys.modules[module_name]
+    if module not in _registered:
+        _registered.append(module)
+        if is_enabled():
+            _wrap_module(module)
+
+
+def enable():
+    """Wrap registered modules and shapely methods to record counts."""
+    if is_enabled():
+        return
+    _enabled[0] = True
+    _wrap_shapely()
+    for module in _registered:
+        _wrap_module(module)
+
+
+def disable():
+    """Remove all wrappers; recorded counts are kept until reset()."""
+    _enabled[0] = False
+    while _patches:
+        owner, name, original = _patches.pop()
+        if original is _MISSING:
+            delattr(owner, name)
+        else:
+            setattr(owner, name, original)
+
+
+def reset():
+    """Forget all recorded counts."""
+    _records.clear()
+
+
+@contextmanager
+def instrumented(clear=True):
+    """Context manager that enables instrumentation within its block.
+
+    Args:
+        clear: optional (default: True) if True, reset counts on entry
+
+    Yields:
+        the function report, to be called after the block
+    """
+    if clear:
+        reset()
+    was_enabled = is_enabled()
+    enable()
+    try:
+        yield report
+    finally:
+        if not was_enabled:
+            disable()
+
+
+def report():
+    """Return recorded counts as dict of function name to dict of counters."""
+    return dict((name, dict(record)) for name, record in _records.items())
+
+
+def report_frame():
+    """Return recorded counts as DataFrame, slowest functions first."""
+    df = pd.DataFrame.from_dict(report(), orient='index')
+    df = df.reindex(columns=list(COUNTERS))
+    df.index.name = 'function'
+    return df.sort_values('seconds', ascending=False)
+
+
+def _count(kind):
+    """Increment counter kind of all functions currently running."""
+    for name, depth in _active.items():
+        if depth:
+            _records[name][kind] += 1
+
+
+def _patch(owner, name, value):
+    """Set attribute name of owner to value, remembering the original."""
+    _patches.append((owner, name, owner.__dict__.get(name, _MISSING)))
+    setattr(owner, name, value)
+
+
+def _wrap_function(name, func):
+    """Return wrapper of func recording calls and time under name."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        record = _records.get(name)
+        if record is None:
+            record = _records[name] = dict.fromkeys(COUNTERS, 0)
+        record['calls'] += 1
+        depth = _active.get(name, 0)
+        _active[name] = depth + 1
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _active[name] = depth
+            if depth == 0:
+                # recursive calls are included in the outermost call's time
+                record['seconds'] += time.time() - started
+    return wrapper
+
+
+def _wrap_shapely_call(kind, method):
+    """Return wrapper of a shapely method counting it as kind."""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if _in_shapely[0]:
+            # shapely calling itself, e.g. almost_equals -> equals_exact
+            return method(*args, **kwargs)
+        _in_shapely[0] = True
+        try:
+            _count(kind)
+            return method(*args, **kwargs)
+        finally:
+            _in_shapely[0] = False
+    return wrapper
+
+
+def _wrap_module(module):
+    """Wrap the public functions defined in module."""
+    for name, obj in list(vars(module).items()):
+        if (not name.startswith('_') and inspect.isfunction(obj) and
+                obj.__module__ == module.__name__):
+            _patch(module, name,
+                   _wrap_function(module.__name__ + '.' + name, obj))
+
+
+def _wrap_shapely():
+    """Wrap shapely predicates, operations and geometry constructors."""
+    import shapely.geometry
+    from shapely.geometry.base import BaseGeometry
+    from shapely.prepared import PreparedGeometry
+
+    classes = [BaseGeometry, PreparedGeometry] + [
+        getattr(shapely.geometry, name) for name in GEOMETRY_CLASSES]
+    for cls in classes:
+        for kind, names in (('predicates', PREDICATES),
+                            ('operations', OPERATIONS)):
+            for name in names:
+                attr = cls.__dict__.get(name)
+                if isinstance(attr, property):
+                    _patch(cls, name, property(
+                        _wrap_shapely_call(kind, attr.fget)))
+                elif inspect.isfunction(attr):
+                    _patch(cls, name, _wrap_shapely_call(kind, attr))
+
+    # shapely 1.x initializes geometries in __init__, shapely 2.x in __new__
+    for name in GEOMETRY_CLASSES:
+        cls = getattr(shapely.geometry, name)
+        if isinstance(cls.__dict__.get('__new__'), staticmethod):
+            _patch(cls, '__new__', staticmethod(_wrap_shapely_call(
+                'constructions', cls.__dict__['__new__'].__func__)))
+        elif inspect.isfunction(cls.__dict__.get('__init__')):
+            _patch(cls, '__init__', _wrap_shapely_call(
+                'constructions', cls.__dict__['__init__']))
+
+
+def _write_report(destination):
+    """Print report or write it to a JSON file (at interpreter exit)."""
+    if destination.lower().endswith('.json'):
+        with open(destination, 'w') as f:
+            json.dump(report(), f, indent=2, sort_keys=True)
+    else:
+        sys.stderr.write(report_frame().to_string() + '\n')
+
+
+if os.environ.get(ENVIRONMENT_VARIABLE):
+    import atexit
+    enable()
+    atexit.register(_write_report, os.environ[ENVIRONMENT_VARIABLE])
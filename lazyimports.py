@@ -0,0 +1,54 @@
+""" lazyimports: defer importing heavy modules until they are really used
+
+Importing numpy, pandas, shapely or pyomo takes a considerable fraction of a
+second each. Modules that only need them in some functions can bind a
+placeholder instead, which imports the real module on first attribute
+access. Scripts that only call light-weight functions then start quickly.
+
+Usage:
+    from lazyimports import lazy_import
+    np = lazy_import('numpy')
+    shapely_geometry = lazy_import('shapely.geometry')
+
+    def f():
+        return np.zeros(3)  # numpy is imported here, on first use
+
+"""
+
+import importlib
+
+__all__ = ["lazy_import", "LazyModule"]
+
+
+class LazyModule(object):
+    """Placeholder for a module, importing it on first attribute access."""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        """Import the module (once) and return it."""
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return "<lazy module '{}' ({})>".format(self.__dict__['_name'], state)
+
+
+def lazy_import(name):
+    """Return a LazyModule for the (dotted) module name."""
+    return LazyModule(name)
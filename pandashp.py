@@ -12,29 +12,52 @@ Usage:
     cities['popdens'] = cities['population'] / cities['area']
     pdshp.write_shp(cities, 'cities_germany_projected_popdens')
 
+    # store nearby features close together and write a spatial index, so
+    # that later reads of a small region only touch a part of the file
+    pdshp.write_shp('cities_sorted', cities, curve='hilbert',
+                    spatial_index=True)
+    munich = pdshp.read_shp('cities_sorted', bbox=(4.4e6, 5.3e6, 4.5e6, 5.4e6))
+
 """
 
 try:
     from itertools import izip as zip
 except ImportError: # zip is a builtin in Python 3.x
     pass
-import numpy as np
-import pandas as pd
-import shapefile
-import shapelytools
+import instrumentation
+import math
+import os
+import struct
 import warnings
-from shapely.geometry import LineString, Point, Polygon
+from lazyimports import lazy_import
+
+# heavy dependencies are only imported when first used
+multiprocessing = lazy_import('multiprocessing')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+shapefile = lazy_import('shapefile')
+shapelytools = lazy_import('shapelytools')
+shapely_geometry = lazy_import('shapely.geometry')
+shapely_prepared = lazy_import('shapely.prepared')
 
-def read_shp(filename):
+def read_shp(filename, bbox=None):
     """Read shapefile to dataframe w/ geometry.
     
     Args:
         filename: ESRI shapefile name to be read  (without .shp extension)
+        bbox: optional (minx, miny, maxx, maxy); if given, only features
+              whose bounds overlap bbox are read. If an up-to-date spatial
+              index (see write_spatial_index) exists, only those features
+              are read from disk, otherwise all features are read and 
+              filtered.
         
     Returns:
         pandas DataFrame with column geometry, containing individual shapely
         Geometry objects (i.e. Point, LineString, Polygon) depending on 
-        the shapefiles original shape type
+        the shapefiles original shape type; its index is the record number.
+        With bbox (or if invalid geometries were skipped), the index thus
+        has gaps and labels are no positions; use df.iloc or 
+        df.reset_index() for positional access.
     
     """
     sr = shapefile.Reader(filename)
@@ -45,22 +68,29 @@ def read_shp(filename):
     cols = [col[0] for col in cols] # extract field name only
     cols.append('geometry')
     
-    records = [row for row in sr.iterRecords()]
+    ids = None
+    if bbox is not None and has_spatial_index(filename):
+        ids = query_spatial_index(filename, bbox).tolist()
+        records = [sr.record(i) for i in ids]
+        shapes = [sr.shape(i) for i in ids]
+    else:
+        records = [row for row in sr.iterRecords()]
+        shapes = sr.iterShapes()
     
     if sr.shapeType == shapefile.POLYGON:
-        geometries = [Polygon(shape.points)
+        geometries = [shapely_geometry.Polygon(shape.points)
                       if len(shape.points) > 2 else np.NaN  # invalid geometry
-                      for shape in sr.iterShapes()]
+                      for shape in shapes]
     elif sr.shapeType == shapefile.POLYLINE:
-        geometries = [LineString(shape.points) for shape in sr.iterShapes()]
+        geometries = [shapely_geometry.LineString(shape.points) for shape in shapes]
     elif sr.shapeType == shapefile.POINT:
-        geometries = [Point(*shape.points[0]) for shape in sr.iterShapes()]
+        geometries = [shapely_geometry.Point(*shape.points[0]) for shape in shapes]
     else:
         raise NotImplementedError
     
     data = [r+[g] for r,g in zip(records, geometries)]
     
-    df = pd.DataFrame(data, columns=cols)
+    df = pd.DataFrame(data, columns=cols, index=ids)
     df = df.convert_objects(convert_numeric=True)
     
     if np.NaN in geometries:
@@ -68,9 +98,17 @@ def read_shp(filename):
         df = df.dropna(subset=['geometry'])
         num_skipped = len(geometries) - len(df)
         warnings.warn('Skipped {} invalid geometrie(s).'.format(num_skipped))
+    
+    if bbox is not None and ids is None:
+        # no spatial index: filter by bounds after reading everything
+        minx, miny, maxx, maxy = bbox
+        df = df[[geom.bounds[0] <= maxx and minx <= geom.bounds[2] and
+                 geom.bounds[1] <= maxy and miny <= geom.bounds[3]
+                 for geom in df.geometry]]
     return df
 
-def write_shp(filename, dataframe, write_index=True):
+def write_shp(filename, dataframe, write_index=True, curve=None,
+              spatial_index=False):
     """Write dataframe w/ geometry to shapefile.
     
     Args:
@@ -78,6 +116,11 @@ def write_shp(filename, dataframe, write_index=True):
         dataframe: a pandas DataFrame with column geometry and homogenous 
                    shape types (Point, LineString, or Polygon)
         write_index: add index as column to attribute tabel (default: true)
+        curve: optional 'hilbert' or 'zorder'; if given, features are
+               written in the order of their bounds along this
+               space-filling curve (see shapelytools.curve_order)
+        spatial_index: optional; if True, write_spatial_index is called on
+                       the written features
         
     Returns:
         Nothing.
@@ -85,6 +128,8 @@ def write_shp(filename, dataframe, write_index=True):
     """
     
     df = dataframe.copy()
+    if curve is not None:
+        df = df.iloc[shapelytools.curve_order(bounds(df).values, curve)]
     if write_index:
         df.reset_index(inplace=True)
     
@@ -92,17 +137,17 @@ def write_shp(filename, dataframe, write_index=True):
     geometry = df.pop('geometry')
 
     # write geometries to shp/shx, according to geometry type
-    if isinstance(geometry.iloc[0], Point):
+    if isinstance(geometry.iloc[0], shapely_geometry.Point):
         sw = shapefile.Writer(shapefile.POINT)
         for point in geometry:
             sw.point(point.x, point.y)
         
-    elif isinstance(geometry.iloc[0], LineString):
+    elif isinstance(geometry.iloc[0], shapely_geometry.LineString):
         sw = shapefile.Writer(shapefile.POLYLINE)
         for line in geometry:
             sw.line([list(line.coords)])
         
-    elif isinstance(geometry.iloc[0], Polygon):
+    elif isinstance(geometry.iloc[0], shapely_geometry.Polygon):
         sw = shapefile.Writer(shapefile.POLYGON)
         for polygon in geometry:
             sw.poly([list(polygon.exterior.coords)])
@@ -132,8 +177,195 @@ def write_shp(filename, dataframe, write_index=True):
 
     sw.save(filename)
     
+    if spatial_index:
+        write_spatial_index(filename, [geom.bounds for geom in geometry])
+    else:
+        remove_spatial_index(filename)
+
+
+SPATIAL_INDEX_EXTENSION = '.spx'
+_SPATIAL_INDEX_HEADER = '<4sIIIQ'
+
+
+def _shp_base(filename):
+    """Return shapefile name without a trailing .shp extension."""
+    base, extension = os.path.splitext(filename)
+    return base if extension.lower() == '.shp' else filename
+
+
+def _spatial_index_name(filename):
+    """Return name of spatial index file for shapefile filename."""
+    return _shp_base(filename) + SPATIAL_INDEX_EXTENSION
+
+
+def write_spatial_index(filename, bounds, node_size=16):
+    """Write a packed R-tree of feature bounds next to a shapefile.
+    
+    The tree is built bottom-up from the features in file order: each node
+    covers node_size consecutive entries of the level below. It is most
+    selective if nearby features are stored close together, e.g. by
+    write_shp(..., curve='hilbert').
+    
+    The file filename.spx starts with a header (magic 'SPX2', node_size,
+    number of features, number of levels; little-endian uint32; size of 
+    the .shp file in bytes; uint64), followed by the number of entries per 
+    level (uint32) and the (minx, miny, maxx, maxy) float64 rows of each 
+    level, root first, features last. Call it after writing the shapefile, 
+    as read_spatial_index rejects an index whose number of features or 
+    .shp file size do not match the shapefile.
+    
+    Args:
+        filename: ESRI shapefile name (without .shp extension)
+        bounds: list of (minx, miny, maxx, maxy), one per feature in order
+        node_size: optional number of children per tree node
+        
+    Returns:
+        Nothing.
+    """
+    bounds = np.asarray(bounds, dtype='<f8').reshape(-1, 4)
+    levels = [bounds]
+    while len(levels[-1]) > 1:
+        below = levels[-1]
+        starts = np.arange(0, len(below), node_size)
+        levels.append(np.hstack([
+            np.minimum.reduceat(below[:, :2], starts),
+            np.maximum.reduceat(below[:, 2:], starts)]))
+    levels.reverse()
+    
+    with open(_spatial_index_name(filename), 'wb') as f:
+        f.write(struct.pack(_SPATIAL_INDEX_HEADER, b'SPX2', node_size,
+                            len(bounds), len(levels), _shp_size(filename)))
+        f.write(struct.pack('<{}I'.format(len(levels)),
+                            *[len(level) for level in levels]))
+        for level in levels:
+            f.write(level.tobytes())
+
+
+def read_spatial_index(filename):
+    """Read spatial index written by write_spatial_index.
+    
+    Args:
+        filename: ESRI shapefile name (without .shp extension)
+        
+    Returns:
+        Tuple (node_size, levels) with levels a list of float arrays of 
+        shape (N, 4), root first, feature bounds last
+    
+    Raises:
+        ValueError if the file is no spatial index or does not match the 
+        shapefile (e.g. because the shapefile was rewritten since)
+    """
+    with open(_spatial_index_name(filename), 'rb') as f:
+        data = f.read()
+    
+    header_size = struct.calcsize(_SPATIAL_INDEX_HEADER)
+    if data[:4] != b'SPX2' or len(data) < header_size:
+        raise ValueError('Not a spatial index file.')
+    magic, node_size, num_features, num_levels, shp_size = struct.unpack_from(
+        _SPATIAL_INDEX_HEADER, data)
+    if (shp_size != _shp_size(filename) or 
+            num_features != _shp_record_count(filename)):
+        raise ValueError('Spatial index does not match shapefile {}.'.format(
+                         filename))
+    sizes = struct.unpack_from('<{}I'.format(num_levels), data, header_size)
+    
+    levels = []
+    offset = header_size + 4 * num_levels
+    for size in sizes:
+        levels.append(np.frombuffer(data, dtype='<f8', count=4 * size,
+                                    offset=offset).reshape(-1, 4))
+        offset += 32 * size
+    return node_size, levels
+
+
+def has_spatial_index(filename):
+    """Return True if an up-to-date spatial index exists for filename."""
+    if not os.path.exists(_spatial_index_name(filename)):
+        return False
+    try:
+        read_spatial_index(filename)
+    except (ValueError, struct.error):
+        return False
+    return True
+
+
+def remove_spatial_index(filename):
+    """Delete the spatial index of filename, if any."""
+    if os.path.exists(_spatial_index_name(filename)):
+        os.remove(_spatial_index_name(filename))
+
+
+def _shp_size(filename):
+    """Return size of the .shp file of filename in bytes (0 if missing)."""
+    shp = _shp_base(filename) + '.shp'
+    return os.path.getsize(shp) if os.path.exists(shp) else 0
+
+
+def _shp_record_count(filename):
+    """Return number of records of filename, read from the .shx size."""
+    shx = _shp_base(filename) + '.shx'
+    if not os.path.exists(shx):
+        return 0
+    return (os.path.getsize(shx) - 100) // 8 # header, 8 bytes per record
+
+
+def query_spatial_index(filename, bbox):
+    """Find record numbers of features whose bounds overlap bbox.
+    
+    Args:
+        filename: ESRI shapefile name (without .shp extension)
+        bbox: (minx, miny, maxx, maxy)
+        
+    Returns:
+        sorted integer array of record numbers
+    """
+    node_size, levels = read_spatial_index(filename)
+    minx, miny, maxx, maxy = bbox
+    
+    candidates = np.arange(len(levels[0]))
+    for k, level in enumerate(levels):
+        b = level[candidates]
+        candidates = candidates[(b[:, 0] <= maxx) & (minx <= b[:, 2]) &
+                                (b[:, 1] <= maxy) & (miny <= b[:, 3])]
+        if k + 1 < len(levels):
+            # descend to the children of the remaining nodes
+            candidates = (candidates[:, np.newaxis] * node_size +
+                          np.arange(node_size)).ravel()
+            candidates = candidates[candidates < len(levels[k + 1])]
+    return candidates
+
+
+def shp_byte_ranges(filename, records):
+    """Return byte ranges of records in the .shp file, read from the .shx.
+    
+    Ranges of records stored back to back are merged, so that a sorted
+    shapefile (see write_shp) yields few long ranges.
+    
+    Args:
+        filename: ESRI shapefile name (without .shp extension)
+        records: sorted list of record numbers (see query_spatial_index)
+        
+    Returns:
+        list of tuples (offset, length) in bytes, including record headers
+    """
+    with open(_shp_base(filename) + '.shx', 'rb') as f:
+        f.seek(100) # skip file header
+        index = np.frombuffer(f.read(), dtype='>i4').reshape(-1, 2)
+    
+    # .shx stores offset and content length in 16-bit words
+    records = np.asarray(records, dtype=np.int64)
+    offsets = index[records, 0].astype(np.int64) * 2
+    ends = offsets + index[records, 1].astype(np.int64) * 2 + 8
+    
+    starts = np.ones(len(records), dtype=bool)
+    starts[1:] = offsets[1:] != ends[:-1]
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(records)) - 1
+    return list(zip(offsets[first].tolist(), (ends[last] - offsets[first]).tolist()))
+    
     
-def match_vertices_and_edges(vertices, edges, vertex_cols=('Vertex1', 'Vertex2')):
+def match_vertices_and_edges(vertices, edges, vertex_cols=('Vertex1', 'Vertex2'),
+                             prepared=False):
     """Adds unique IDs to vertices and corresponding edges.
     
     Identifies, which nodes coincide with the endpoints of edges and creates
@@ -146,6 +378,9 @@ def match_vertices_and_edges(vertices, edges, vertex_cols=('Vertex1', 'Vertex2')
         vertices: pandas DataFrame with geometry column of type Point
         edges: pandas DataFrame with geometry column of type LineString
         vertex_cols: tuple of 2 strings for the IDs numbers
+        prepared: optional (default: False) True or a 
+                  shapelytools.PreparedCache to test vertices against 
+                  prepared versions of the edges
         
     Returns:
         Nothing, the mathing IDs are added to the columns vertex_cols in 
@@ -154,6 +389,7 @@ def match_vertices_and_edges(vertices, edges, vertex_cols=('Vertex1', 'Vertex2')
     
     vertex_indices = []
     for e, line in enumerate(edges.geometry):
+        line = shapelytools.prepared_geometry(line, prepared)
         edge_endpoints = []
         for k, vertex in enumerate(vertices.geometry):
             if line.touches(vertex) or line.intersects(vertex):
@@ -171,7 +407,8 @@ def match_vertices_and_edges(vertices, edges, vertex_cols=('Vertex1', 'Vertex2')
     edges[vertex_cols[1]] = pd.Series([max(n1n2) for n1n2 in vertex_indices],
                                       index=edges.index)
 
-def find_closest_edge(polygons, edges, to_attr='index', column='nearest'):
+def find_closest_edge(polygons, edges, to_attr='index', column='nearest',
+                      workers=1):
     """Find closest edge for centroid of polygons.
     
     Args:
@@ -180,6 +417,10 @@ def find_closest_edge(polygons, edges, to_attr='index', column='nearest'):
         to_attr: a column name in DataFrame edges (default: index)
         column: a column name to be added/overwrite in DataFrame polygons with
                 the value of column to_attr from the nearest edge in edges
+        workers: optional number of processes (default: 1); if greater, 
+                 edges are shared once via memory-mapped arrays and chunks
+                 of centroids are matched in a process pool using a grid 
+                 index (see shapelytools.closest_lines)
     
     Returns:
         a list of LineStrings connecting polygons' centroids with the nearest 
@@ -192,20 +433,265 @@ def find_closest_edge(polygons, edges, to_attr='index', column='nearest'):
     nearest_indices = []
     centroids = [b.centroid for b in polygons['geometry']]
     
+    if workers > 1:
+        nearest, _, nearest_points = shapelytools.closest_lines(
+            edges['geometry'], centroids, workers=workers)
+        connecting_lines = [shapely_geometry.LineString([centroid.coords[0], tuple(point)])
+                            for centroid, point in zip(centroids, nearest_points)]
+        nearest_indices = [edges[to_attr].iloc[k] for k in nearest]
+        polygons[column] = pd.Series(nearest_indices, index=polygons.index)
+        return pd.DataFrame({'geometry': connecting_lines})
+    
+    # closest_object returns positions, so work on a list, not the Series
+    edge_geometries = list(edges['geometry'])
     for centroid in centroids:
         nearest_edge, _, nearest_index = shapelytools.closest_object(
-                                         edges['geometry'], centroid)
+                                         edge_geometries, centroid)
         nearest_point = shapelytools.project_point_to_object(centroid, nearest_edge)
         
-        connecting_lines.append(LineString(tuple(centroid.coords) + 
+        connecting_lines.append(shapely_geometry.LineString(tuple(centroid.coords) + 
                                            tuple(nearest_point.coords)))
         
-        nearest_indices.append(edges[to_attr][nearest_index])
+        nearest_indices.append(edges[to_attr].iloc[nearest_index])
     
     polygons[column] = pd.Series(nearest_indices, index=polygons.index)
     
     return pd.DataFrame({'geometry': connecting_lines})
 
+def sjoin(left, right, predicate='intersects', cell_size=None):
+    """Find all pairs of geometries of two DataFrames fulfilling a predicate.
+    
+    Candidate pairs are found with a grid index of the bounding boxes of 
+    both DataFrames (see bounds), then refined with shapely's prepared 
+    geometries. For predicate 'contains', left geometries are prepared, for
+    'within' right ones; for 'intersects' the side with fewer distinct 
+    candidates. Each prepared geometry is tested against all its candidates
+    in a row.
+    
+    Usage:
+        # which polygon contains each point?
+        pairs = sjoin(polygons, points, 'contains')
+    
+    Args:
+        left: a pandas DataFrame with geometry column
+        right: a pandas DataFrame with geometry column
+        predicate: 'intersects' (default), 'contains' (left contains right)
+                   or 'within' (left within right)
+        cell_size: optional grid cell size for the bounding box index
+    
+    Returns:
+        a pandas DataFrame with columns left and right, containing the index
+        labels of matching pairs, sorted by position in left and right
+    """
+    if predicate not in ('intersects', 'contains', 'within'):
+        raise ValueError("Unknown predicate '{}'".format(predicate))
+    
+    if left.empty or right.empty:
+        # no pairs; keep the dtypes of both indices
+        return pd.DataFrame({'left': left.index.values[:0],
+                             'right': right.index.values[:0]},
+                            columns=['left', 'right'])
+    
+    i, j = shapelytools.grid_candidate_pairs(bounds(left).values, 
+                                             bounds(right).values, cell_size)
+    left_geometry = left['geometry'].values
+    right_geometry = right['geometry'].values
+    
+    # prepare geometries on the side that is tested repeatedly
+    prepare_left = (predicate == 'contains' or
+                    (predicate == 'intersects' and 
+                     len(np.unique(i)) <= len(np.unique(j))))
+    if predicate == 'within':
+        test = 'contains' # left within right == right contains left
+    else:
+        test = predicate
+    if prepare_left:
+        prepared_side, other_side = i, j
+        prepared_geometry, other_geometry = left_geometry, right_geometry
+    else:
+        prepared_side, other_side = j, i
+        prepared_geometry, other_geometry = right_geometry, left_geometry
+    
+    order = np.lexsort((other_side, prepared_side))
+    prepared_side, other_side = prepared_side[order], other_side[order]
+    match = np.zeros(len(order), dtype=bool)
+    current, prepared = None, None
+    for n, (p, o) in enumerate(zip(prepared_side.tolist(), other_side.tolist())):
+        if p != current:
+            current, prepared = p, shapely_prepared.prep(prepared_geometry[p])
+        match[n] = getattr(prepared, test)(other_geometry[o])
+    
+    if prepare_left:
+        i, j = prepared_side[match], other_side[match]
+    else:
+        i, j = other_side[match], prepared_side[match]
+    order = np.lexsort((j, i))
+    return pd.DataFrame({'left': left.index.values[i[order]],
+                         'right': right.index.values[j[order]]},
+                        columns=['left', 'right'])
+
+def map_partitions(filename, func, cell_size, halo, others=(), 
+                   result='input', as_lines=False, workers=1, kwargs=None):
+    """Apply a spatially local function to a shapefile partition by partition.
+    
+    The extent of the shapefile is split into square cells. For each cell,
+    the features overlapping the cell plus a margin of width halo are read
+    with read_shp(..., bbox=...) and passed to func; workers only ever hold
+    one partition in memory. Each input feature is owned by the cell that 
+    contains the center of its bounding box. From each partition's result,
+    only what the cell owns is kept, so that the reassembled result 
+    contains each feature once. Argument result tells how func's result 
+    relates to its input:
+    
+        'input'  func modifies its first DataFrame in place, e.g. adds a 
+                 column (its return value is ignored); the owned rows of
+                 that DataFrame are the result
+        'rows'   func returns a DataFrame of (a subset of) the rows of its 
+                 first DataFrame, identified by their index
+        'new'    func returns a DataFrame of new features with a geometry
+                 column; these are owned by the cell containing the center 
+                 of their bounding box, so neighboring partitions must 
+                 create them identically (i.e. halo must be big enough)
+    
+    Frames passed to func are indexed by record number, so labels refer to 
+    the same feature in all partitions (e.g. vertex ids written by 
+    match_vertices_and_edges). Use positions (iloc) for anything else.
+    
+    Partitions are read using the spatial index (see write_spatial_index),
+    which is created first if it does not exist yet or is out of date. For correct results,
+    halo must exceed the distance over which func relates features (e.g. 
+    max_distance of snappy_endings) plus the extent of a single feature.
+    
+    Usage:
+        # add column nearest to buildings (a side effect of the function)
+        map_partitions('buildings', find_closest_edge, 5000, 1000, 
+                       others=['roads'], kwargs={'to_attr': 'index'})
+        # snap line ends; result holds the owned lines, bent or not
+        map_partitions('roads', shapelytools.snappy_endings, 5000, 100, 
+                       as_lines=True, kwargs={'max_distance': 10})
+    
+    Args:
+        filename: ESRI shapefile name (without .shp extension)
+        func: a function func(df, *other_dfs, **kwargs), picklable (i.e.
+              defined at module level) if workers > 1
+        cell_size: edge length of the partition cells
+        halo: width of the margin read around each cell
+        others: optional list of further shapefile names, whose features 
+                within the same padded cell are passed as further arguments
+        result: optional 'input' (default), 'rows' or 'new' (see above)
+        as_lines: optional (default: False) if True, func is called with a 
+                  shapelytools.LineIndex of the lines instead of a DataFrame
+                  and must update or delete its lines in place, e.g. 
+                  snappy_endings or prune_short_lines (others are passed as
+                  lists of geometries); the result holds the owned lines 
+                  still in the index, with their new geometry, and argument
+                  result is ignored
+        workers: optional number of processes (default: 1, no pool)
+        kwargs: optional dict of keyword arguments for func
+    
+    Returns:
+        DataFrame of all owned result features; indexed by record number,
+        or by position for result='new'
+    """
+    if result not in ('input', 'rows', 'new'):
+        raise ValueError("Unknown result '{}'.".format(result))
+    
+    names = [filename] + list(others)
+    for name in names:
+        if not has_spatial_index(name):
+            _write_spatial_index_from_file(name)
+    
+    minx, miny, maxx, maxy = shapefile.Reader(filename).bbox
+    num_x = max(int(math.ceil((maxx - minx) / cell_size)), 1)
+    num_y = max(int(math.ceil((maxy - miny) / cell_size)), 1)
+    grid = (minx, miny, cell_size, num_x, num_y)
+    tasks = [(names, grid, (ix, iy), halo, func, result, as_lines, 
+              kwargs or {})
+             for ix in range(num_x) for iy in range(num_y)]
+    
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_map_partition, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_map_partition(task) for task in tasks]
+    
+    results = [df for df in results if df is not None]
+    if not results:
+        return pd.DataFrame()
+    df = pd.concat(results)
+    if result == 'new' and not as_lines:
+        return df.reset_index(drop=True)
+    return df.sort_index()
+
+
+def _map_partition(args):
+    """Read, process and trim one partition of map_partitions."""
+    names, grid, cell, halo, func, result, as_lines, kwargs = args
+    minx, miny, cell_size, _, _ = grid
+    x0, y0 = minx + cell[0] * cell_size, miny + cell[1] * cell_size
+    padded = (x0 - halo, y0 - halo, x0 + cell_size + halo, y0 + cell_size + halo)
+    
+    frames = [read_shp(name, bbox=padded) for name in names]
+    df = frames[0]
+    if df.empty:
+        return None
+    owned = [_cell_of(geom.bounds, grid) == cell for geom in df.geometry]
+    if not any(owned) and (as_lines or result != 'new'):
+        # new features may be owned by a cell without own input features
+        return None
+    owned = pd.Series(owned, index=df.index)
+    
+    if as_lines:
+        # LineIndex ids are the positions of the lines in df
+        index = shapelytools.LineIndex(list(df.geometry))
+        func(index, *[list(frame.geometry) for frame in frames[1:]], **kwargs)
+        ids = index.ids()
+        if ids and ids[-1] >= len(df):
+            raise ValueError('func inserted lines into the LineIndex.')
+        df = df.iloc[ids].copy()
+        df['geometry'] = [index[i] for i in ids]
+        return df[owned[df.index].values]
+    
+    returned = func(*frames, **kwargs)
+    if result == 'input':
+        return df[owned.values]
+    if result == 'rows':
+        if not returned.index.isin(df.index).all():
+            raise ValueError('func returned rows that are not in its input.')
+        return returned[owned[returned.index].values]
+    owned = [_cell_of(geom.bounds, grid) == cell 
+             for geom in returned.geometry]
+    return returned[owned]
+
+
+def _cell_of(bounds, grid):
+    """Return grid cell (ix, iy) containing the center of bounds."""
+    minx, miny, cell_size, num_x, num_y = grid
+    x = (bounds[0] + bounds[2]) / 2.0
+    y = (bounds[1] + bounds[3]) / 2.0
+    ix = min(max(int(math.floor((x - minx) / cell_size)), 0), num_x - 1)
+    iy = min(max(int(math.floor((y - miny) / cell_size)), 0), num_y - 1)
+    return (ix, iy)
+
+
+def _write_spatial_index_from_file(filename):
+    """Write spatial index for an existing shapefile, reading shapes one by one."""
+    bounds = []
+    for shape in shapefile.Reader(filename).iterShapes():
+        if not shape.points:
+            # null shape: bounds that overlap nothing
+            bounds.append((np.inf, np.inf, -np.inf, -np.inf))
+            continue
+        xs = [point[0] for point in shape.points]
+        ys = [point[1] for point in shape.points]
+        bounds.append((min(xs), min(ys), max(xs), max(ys)))
+    write_spatial_index(filename, bounds)
+
+
 def bounds(df):
     """Return a DataFrame of minx, miny, maxx, maxy of each geometry."""
     bounds = np.array([geom.bounds for geom in df.geometry])
@@ -215,8 +701,12 @@ def bounds(df):
     
 def total_bounds(df):
     """Return bounding box (minx, miny, maxx, maxy) of all geometries. """
-    b = bounds(df)
-    return (b['minx'].min(),
-            b['miny'].min(),
-            b['maxx'].max(),
-            b['maxy'].max())
+    # plain Python on purpose, so that numpy/pandas need not be imported
+    all_bounds = [geom.bounds for geom in df.geometry]
+    if not all_bounds:
+        return (float('nan'),) * 4 # like min/max of an empty column
+    minx, miny, maxx, maxy = zip(*all_bounds)
+    return (min(minx), min(miny), max(maxx), max(maxy))
+
+
+instrumentation.register(__name__)
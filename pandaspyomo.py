@@ -12,28 +12,48 @@ Usage:
         [('EprOut', ['time', 'process', 'commodity', 'commodity']), ... 
          ('EprIn',  ['time', 'process', 'commodity', 'commodity'])]
     epr = pdpo.get_entities(instance, ['EprOut', 'EprInt'])
+    # only non-zero flows, with categorical index levels
+    epr = pdpo.get_entity(instance, 'EprOut', nonzero=True, categorical=True)
     ...
     
 """
 
-import coopr.pyomo as pyomo
-import pandas as pd
+from lazyimports import lazy_import
 
-def get_entity(instance, name):
+# heavy dependencies are only imported when first used
+pyomo = lazy_import('coopr.pyomo')
+pd = lazy_import('pandas')
+
+def get_entity(instance, name, nonzero=False, tol=0.0, categorical=False):
     """ Return a DataFrame for an entity in model instance.
 
     Args:
         instance: a Pyomo ConcreteModel instance
         name: name of a Set, Param, Var, Constraint or Objective
+        nonzero: optional; if True, skip entries whose absolute value is
+                 at most tol (and entries without value) while extracting;
+                 has no effect on Sets
+        tol: optional tolerance for nonzero (default: 0.0)
+        categorical: optional; if True, index levels are Categoricals whose
+                     categories are the elements of the domain sets
 
     Returns:
-        a single-columned Pandas DataFrame with domain as index
+        a single-columned Pandas DataFrame with domain as index; it has no
+        rows if the entity is empty or (with nonzero) all zero
     """
 
     # retrieve entity, its type and its onset names
     entity = instance.__getattribute__(name)
     labels = _get_onset_names(entity)
 
+    # helper function to decide whether an entry is kept
+    if nonzero:
+        def keep(value):
+            return value is not None and abs(value) > tol
+    else:
+        def keep(value):
+            return True
+
     # extract values
     if isinstance(entity, pyomo.Set):
         # Pyomo sets don't have values, only elements
@@ -49,20 +69,24 @@ def get_entity(instance, name):
 
     elif isinstance(entity, pyomo.Param):
         if entity.dim() > 1:
-            results = pd.DataFrame([v[0]+(v[1],) for v in entity.iteritems()])
+            results = pd.DataFrame([v[0]+(v[1],) for v in entity.iteritems()
+                                    if keep(v[1])])
         else:
-            results = pd.DataFrame(entity.iteritems())
+            results = pd.DataFrame([v for v in entity.iteritems()
+                                    if keep(v[1])])
     else:
         # create DataFrame
         if entity.dim() > 1:
             # concatenate index tuples with value if entity has
             # multidimensional indices v[0]
             results = pd.DataFrame(
-                [v[0]+(v[1].value,) for v in entity.iteritems()])
+                [v[0]+(v[1].value,) for v in entity.iteritems()
+                 if keep(v[1].value)])
         else:
             # otherwise, create tuple from scalar index v[0]
             results = pd.DataFrame(
-                [(v[0], v[1].value) for v in entity.iteritems()])
+                [(v[0], v[1].value) for v in entity.iteritems()
+                 if keep(v[1].value)])
 
     # check for duplicate onset names and append one to several "_" to make
     # them unique, e.g. ['sit', 'sit', 'com'] becomes ['sit', 'sit_', 'com']
@@ -70,15 +94,41 @@ def get_entity(instance, name):
         if label in labels[:k]:
             labels[k] = labels[k] + "_"
 
-    if not results.empty:
+    if results.empty:
+        # e.g. all entries skipped by nonzero; keep columns and index names,
+        # so that get_entities can still join the result
+        results = pd.DataFrame(columns=labels + [name])
+    else:
         # name columns according to labels + entity name
         results.columns = labels + [name]
+    if categorical and labels:
+        _to_categorical(results, labels, _get_onset_elements(entity))
+    if labels:
         results.set_index(labels, inplace=True)
 
     return results
 
 
-def get_entities(instance, names):
+def _to_categorical(results, labels, elements):
+    """ Convert index columns of results to Categoricals in place.
+
+    Args:
+        results: DataFrame with columns labels
+        labels: list of index column names
+        elements: list of domain set elements per label (see
+                  _get_onset_elements), or None if unknown
+    """
+    if elements is None or len(elements) != len(labels):
+        elements = [None] * len(labels)
+    for label, categories in zip(labels, elements):
+        column = pd.Categorical(results[label], categories=categories)
+        if categories is not None and (column.codes < 0).any():
+            # value outside the presumed domain; use observed values instead
+            column = pd.Categorical(results[label])
+        results[label] = column
+
+
+def get_entities(instance, names, nonzero=False, tol=0.0, categorical=False):
     """ Return one DataFrame with entities in columns and a common index.
 
     Works only on entities that share a common domain (set or set_tuple), which
@@ -87,16 +137,19 @@ def get_entities(instance, names):
     Args:
         instance: a Pyomo ConcreteModel instance
         names: list of entity names (as returned by list_entities)
+        nonzero, tol, categorical: optional, see get_entity; with nonzero,
+                 an index is kept if any of the entities is non-zero there
 
     Returns:
         a Pandas DataFrame with entities as columns and domains as index
     """
 
-    df = pd.DataFrame()
+    df = None
     for name in names:
-        other = get_entity(instance, name)
+        other = get_entity(instance, name, nonzero=nonzero, tol=tol,
+                           categorical=categorical)
 
-        if df.empty:
+        if df is None:
             df = other
         else:
             index_names_before = df.index.names
@@ -106,7 +159,7 @@ def get_entities(instance, names):
             if index_names_before != df.index.names:
                 df.index.names = index_names_before
 
-    return df
+    return df if df is not None else pd.DataFrame()
 
 
 def list_entities(instance, entity_type):
@@ -205,4 +258,45 @@ def _get_onset_names(entity):
     else:
         raise ValueError("Unknown entity type!")
 
-    return labels
\ No newline at end of file
+    return labels
+
+
+def _get_onset_elements(entity):
+    """ Return list of element lists of the domain sets of an entity.
+
+    Follows the same structure as _get_onset_names, i.e. returns one list
+    of set elements per onset name. The elements of each set are sorted, if
+    possible.
+    """
+    elements = []
+
+    if isinstance(entity, pyomo.Set):
+        if entity.dimen > 1:
+            if entity.domain:
+                domains = entity.domain.set_tuple
+            else:
+                domains = entity.set_tuple
+
+            for domain_set in domains:
+                elements.extend(_get_onset_elements(domain_set))
+
+        elif entity.dimen == 1:
+            if entity.domain:
+                values = entity.domain.value
+            else:
+                values = entity.value
+            try:
+                elements.append(sorted(values))
+            except TypeError:
+                # mixed, unorderable element types
+                elements.append(list(values))
+
+    elif isinstance(entity, (pyomo.Param, pyomo.Var, pyomo.Constraint,
+                    pyomo.Objective)):
+        if entity.dim() > 0 and entity._index:
+            elements = _get_onset_elements(entity._index)
+
+    else:
+        raise ValueError("Unknown entity type!")
+
+    return elements
\ No newline at end of file
@@ -1,7 +1,10 @@
 """ pyomotools: common helper functions for pyomo model creation """
 from datetime import datetime
-import pandas as pd
-import xlrd
+from lazyimports import lazy_import
+
+# heavy dependencies are only imported when first used
+pd = lazy_import('pandas')
+xlrd = lazy_import('xlrd')
 
 __all__ = ["now", "read_xls"]
 
@@ -1,26 +1,356 @@
 from shapely.geometry import (box, LineString, MultiLineString, MultiPoint, 
     Point, Polygon)
+import collections
+import heapq
+import instrumentation
+import itertools
+import math
+import multiprocessing
+import os
+import pickle
 import shapely.ops
+import shutil
+import tempfile
+from shapely.prepared import prep
+from lazyimports import lazy_import
 
-def endpoints_from_lines(lines):
-    """Return list of terminal points from list of LineStrings."""
+# shapely is needed by nearly every function, but numpy only by some
+np = lazy_import('numpy')
+
+# tolerance of shapely's almost_equals with its default decimal=6
+_ALMOST_EQUAL = 0.5e-6
+
+
+class PreparedCache(object):
+    """Bounded LRU cache of prepared geometries, keyed by object identity.
+    
+    Preparing a geometry builds GEOS index structures that make repeated 
+    predicate tests (touches, intersects, contains, ...) against it faster.
+    Entries keep a reference to their geometry, so an id is never reused 
+    while it is cached.
+    
+    Usage:
+        cache = PreparedCache(maxsize=256)
+        cache(line).touches(point)  # prepares line
+        cache(line).touches(other_point)  # reuses prepared line
+    """
+    
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+    
+    def __call__(self, geometry):
+        """Return prepared version of geometry, preparing it if needed."""
+        key = id(geometry)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = (geometry, prep(geometry))
+            if len(self._entries) >= self.maxsize:
+                self._entries.popitem(last=False) # least recently used
+        self._entries[key] = entry
+        return entry[1]
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def clear(self):
+        """Remove all entries and reset hit/miss counters."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# shared cache used by functions called with prepared=True; it keeps up to 
+# maxsize (1024) geometries and their prepared versions alive for the whole
+# process, so call prepared_cache.clear() to release them after a big job,
+# or pass an own PreparedCache instead of True to limit its lifetime
+prepared_cache = PreparedCache()
+
+
+def prepared_geometry(geometry, prepared):
+    """Return geometry or its cached prepared version for predicate tests.
+    
+    Args:
+        geometry: a shapely geometry
+        prepared: False/None (no preparation), True (use prepared_cache) or
+                  a PreparedCache instance
+    """
+    if not prepared:
+        return geometry
+    if prepared is True:
+        prepared = prepared_cache
+    return prepared(geometry)
+
+
+class LineIndex(object):
+    """Collection of LineStrings with a spatial and an endpoint index.
+    
+    Lines are stored under stable integer ids. A uniform grid of cells maps
+    to the ids of all lines whose bounding box overlaps that cell, and a dict
+    maps each endpoint coordinate to the ids of the lines ending there. Both
+    indices are updated incrementally on insert, delete and update, so that
+    a sequence of cleaning steps (e.g. snappy_endings, prune_short_lines, 
+    one_linestring_per_intersection), which all accept a LineIndex instead 
+    of a list, builds them only once.
     
-    all_points = []
-    for line in lines:
-        for i in [0, -1]: # start and end point
-            all_points.append(line.coords[i])
+    A LineIndex can be pickled, or written to and read from a file using 
+    save and LineIndex.load.
     
-    unique_points = set(all_points)
+    Usage:
+        index = LineIndex(lines)
+        snappy_endings(index, 5)
+        prune_short_lines(index, 10)
+        lines = list(index)
+    """
+    
+    def __init__(self, lines=(), cell_size=None):
+        """Create index from a list of LineStrings or a MultiLineString.
+        
+        Args:
+            lines: optional initial list of LineStrings
+            cell_size: optional edge length of the grid cells (default: 
+                       median bounding box extent of the initial lines)
+        """
+        lines = [line for line in lines] # converts MultiLineString to list
+        if cell_size is None:
+            extents = [max(maxx - minx, maxy - miny) 
+                       for minx, miny, maxx, maxy in 
+                       (line.bounds for line in lines)]
+            cell_size = float(np.median(extents)) if extents else 0
+            if not cell_size > 0:
+                cell_size = 1.0
+        self.cell_size = cell_size
+        self.lines = {}      # id -> LineString
+        self.bounds = {}     # id -> (minx, miny, maxx, maxy)
+        self.cells = {}      # (ix, iy) -> set of ids
+        self.endpoints = {}  # coordinate tuple -> set of ids
+        self._next_id = 0
+        for line in lines:
+            self.insert(line)
+    
+    def __len__(self):
+        return len(self.lines)
+    
+    def __iter__(self):
+        """Iterate over lines in order of their ids."""
+        return (self.lines[k] for k in self.ids())
+    
+    def __getitem__(self, line_id):
+        return self.lines[line_id]
+    
+    def ids(self):
+        """Return sorted list of line ids."""
+        return sorted(self.lines)
+    
+    def _cell_range(self, bounds):
+        minx, miny, maxx, maxy = bounds
+        ix0, iy0 = int(minx // self.cell_size), int(miny // self.cell_size)
+        ix1, iy1 = int(maxx // self.cell_size), int(maxy // self.cell_size)
+        return ix0, iy0, ix1, iy1
+    
+    def _cells_of(self, bounds):
+        ix0, iy0, ix1, iy1 = self._cell_range(bounds)
+        return [(ix, iy) for ix in range(ix0, ix1 + 1) 
+                         for iy in range(iy0, iy1 + 1)]
+    
+    @staticmethod
+    def _ends(line):
+        return (tuple(line.coords[0]), tuple(line.coords[-1]))
+    
+    def insert(self, line):
+        """Add a LineString and return its new id."""
+        line_id = self._next_id
+        self._next_id += 1
+        self.lines[line_id] = line
+        self.bounds[line_id] = line.bounds
+        for cell in self._cells_of(line.bounds):
+            self.cells.setdefault(cell, set()).add(line_id)
+        for point in self._ends(line):
+            self.endpoints.setdefault(point, set()).add(line_id)
+        return line_id
     
-    return [Point(p) for p in unique_points]
+    def delete(self, line_id):
+        """Remove the line with given id."""
+        line = self.lines.pop(line_id)
+        for cell in self._cells_of(self.bounds.pop(line_id)):
+            self.cells[cell].discard(line_id)
+            if not self.cells[cell]:
+                del self.cells[cell]
+        for point in self._ends(line):
+            ids = self.endpoints.get(point)
+            if ids is not None:
+                ids.discard(line_id)
+                if not ids:
+                    del self.endpoints[point]
+    
+    def update(self, line_id, line):
+        """Replace the line with given id by a new (e.g. bent) LineString."""
+        self.delete(line_id)
+        self.lines[line_id] = line
+        self.bounds[line_id] = line.bounds
+        for cell in self._cells_of(line.bounds):
+            self.cells.setdefault(cell, set()).add(line_id)
+        for point in self._ends(line):
+            self.endpoints.setdefault(point, set()).add(line_id)
+    
+    def clear(self):
+        """Remove all lines (ids are not reused)."""
+        self.lines.clear()
+        self.bounds.clear()
+        self.cells.clear()
+        self.endpoints.clear()
+    
+    def query(self, bounds):
+        """Return sorted ids of lines whose bounding box overlaps bounds.
+        
+        Args:
+            bounds: tuple (minx, miny, maxx, maxy) or a shapely geometry
+        """
+        if hasattr(bounds, 'bounds'):
+            bounds = bounds.bounds
+        minx, miny, maxx, maxy = bounds
+        ix0, iy0, ix1, iy1 = self._cell_range(bounds)
+        
+        candidates = set()
+        if (ix1 - ix0 + 1) * (iy1 - iy0 + 1) > len(self.cells):
+            # huge query region: cheaper to scan the occupied cells only
+            for (ix, iy), ids in self.cells.items():
+                if ix0 <= ix <= ix1 and iy0 <= iy <= iy1:
+                    candidates.update(ids)
+        else:
+            for cell in self._cells_of(bounds):
+                candidates.update(self.cells.get(cell, ()))
+        
+        return sorted(k for k in candidates
+                      if self.bounds[k][0] <= maxx and minx <= self.bounds[k][2]
+                      and self.bounds[k][1] <= maxy and miny <= self.bounds[k][3])
+    
+    def lines_ending_at(self, point):
+        """Return sorted ids of lines with an endpoint at the given point."""
+        if hasattr(point, 'coords'):
+            point = point.coords[0]
+        return sorted(self.endpoints.get(tuple(point), ()))
+    
+    def save(self, filename):
+        """Write index to a file (pickle)."""
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+    
+    @classmethod
+    def load(cls, filename):
+        """Read index from a file written by save."""
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+
+def endpoints_from_lines(lines):
+    """Return list of terminal points from list of LineStrings.
+    
+    Points are unique and sorted by (x, y); see endpoints_array for a
+    version without Point objects.
+    """
+    return endpoints_array(lines, as_points=True)[0]
     
 def vertices_from_lines(lines):
-    """Return list of unique vertices from list of LineStrings."""
+    """Return list of unique vertices from list of LineStrings.
+    
+    Points are sorted by (x, y); see vertices_array for a version without 
+    Point objects.
+    """
+    return vertices_array(lines, as_points=True)[0]
+
+
+def unique_coords(coords, tolerance=None):
+    """Deduplicate coordinates by sorting, optionally snapping close ones.
+    
+    Args:
+        coords: float array of shape (N, 2), or (N, 3) with Z coordinates
+        tolerance: optional distance; coordinates that are at most this far 
+                   apart in both x and y (also transitively) are merged into 
+                   the (x, y)-smallest of them
+    
+    Returns:
+        Tuple (unique, inverse, counts) with unique sorted coordinates of 
+        shape (M, 2) or (M, 3), inverse indices so that unique[inverse] 
+        approximates coords, and the number of input coordinates per unique 
+        coordinate
+    """
+    coords = np.asarray(coords, dtype=float)
+    coords = coords.reshape(-1, coords.shape[-1] if coords.ndim == 2 else 2)
+    if len(coords) == 0:
+        return coords, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    
+    # sort by (x, y[, z]); much faster than np.unique(coords, axis=0)
+    order = np.lexsort(coords.T[::-1])
+    sorted_coords = coords[order]
+    is_new = np.ones(len(coords), dtype=bool)
+    is_new[1:] = (sorted_coords[1:] != sorted_coords[:-1]).any(axis=1)
+    unique = sorted_coords[is_new]
+    inverse = np.empty(len(coords), dtype=np.int64)
+    inverse[order] = np.cumsum(is_new) - 1
+    if tolerance:
+        representative = _snap_nodes(unique[:, :2], 
+                                     np.ones(len(unique), dtype=bool),
+                                     tolerance)
+        kept, new_index = np.unique(representative, return_inverse=True)
+        unique, inverse = unique[kept], new_index.ravel()[inverse]
+    
+    counts = np.bincount(inverse, minlength=len(unique))
+    return unique, inverse, counts
+
+
+def endpoints_array(lines, tolerance=None, as_points=False):
+    """Find unique line endpoints using packed coordinate arrays.
     
-    vertices = []
-    for line in lines:
-        vertices.extend(list(line.coords))
-    return [Point(p) for p in set(vertices)]
+    Args:
+        lines: a list of LineStrings or a MultiLineString
+        tolerance: optional snapping distance (see unique_coords)
+        as_points: optional (default: False) return a list of Points instead
+                   of a coordinate array as first result
+    
+    Returns:
+        Tuple (endpoints, counts, line_ends) of unique endpoints sorted by 
+        (x, y) as an array of shape (M, 2), or (M, 3) if the lines have Z 
+        coordinates, the number of line ends at each 
+        endpoint and an integer array of shape (len(lines), 2) with the 
+        indices of each line's start and end point
+    """
+    coords, offsets = pack_lines(lines, keep_z=True)
+    ends = np.concatenate([coords[offsets[:-1]], coords[offsets[1:] - 1]])
+    endpoints, inverse, counts = unique_coords(ends, tolerance)
+    line_ends = inverse.reshape(2, -1).T
+    if as_points:
+        endpoints = [Point(p) for p in endpoints]
+    return endpoints, counts, line_ends
+
+
+def vertices_array(lines, tolerance=None, as_points=False):
+    """Find unique vertices of lines using packed coordinate arrays.
+    
+    Args:
+        lines: a list of LineStrings or a MultiLineString
+        tolerance: optional snapping distance (see unique_coords)
+        as_points: optional (default: False) return a list of Points instead
+                   of a coordinate array as first result
+    
+    Returns:
+        Tuple (vertices, counts, vertex_index, offsets) of unique vertices 
+        sorted by (x, y) as an array of shape (M, 2), or (M, 3) if the lines
+        have Z coordinates, the number of 
+        occurrences of each vertex, and the vertex indices of all line
+        vertices, so that vertex_index[offsets[k]:offsets[k+1]] belong to
+        line k
+    """
+    coords, offsets = pack_lines(lines, keep_z=True)
+    vertices, vertex_index, counts = unique_coords(coords, tolerance)
+    if as_points:
+        vertices = [Point(p) for p in vertices]
+    return vertices, counts, vertex_index, offsets
 
 
 def prune_short_lines(lines, min_length):
@@ -31,12 +361,28 @@ def prune_short_lines(lines, min_length):
     lines are contracted towards the centroid of the removed line.
     
     Args:
-        lines: list of LineStrings or a MultiLineString
+        lines: list of LineStrings, a MultiLineString or a LineIndex
         min_length: minimum length of a single LineString to be preserved
         
     Returns:
-        the pruned pandas DataFrame
+        the pruned pandas DataFrame; for a LineIndex, the index itself, 
+        which is pruned in place
     """   
+    if isinstance(lines, LineIndex):
+        to_prune = []
+        for i in lines.ids():
+            line = lines[i]
+            if line.length < min_length:
+                to_prune.append(i)
+                for n in neighbors(lines, line):
+                    contact_point = line.intersection(lines[n])
+                    lines.update(n, bend_towards(lines[n], 
+                                                 where=contact_point,
+                                                 to=line.centroid))
+        for i in to_prune:
+            lines.delete(i)
+        return lines
+    
     pruned_lines = [line for line in lines] # converts MultiLineString to list
     to_prune = []
     
@@ -52,17 +398,27 @@ def prune_short_lines(lines, min_length):
     return [line for i, line in enumerate(pruned_lines) if i not in to_prune] 
 
 
-def neighbors(lines, of):
+def neighbors(lines, of, prepared=False):
     """Find the indices in a list of LineStrings that touch a given LineString.
     
     Args:
-        lines: list of LineStrings in which to search for neighbors
+        lines: list of LineStrings or LineIndex in which to search for 
+               neighbors
         of: the LineString which must be touched
+        prepared: optional (default: False) True or a PreparedCache to test
+                  against a prepared version of LineString of
         
     Returns:
-        list of indices, so that all lines[indices] touch the LineString of
+        list of indices (or LineIndex ids), so that all lines[indices] touch 
+        the LineString of
     """
-    return [k for k, line in enumerate(lines) if line.touches(of)]
+    candidates = None
+    if isinstance(lines, LineIndex):
+        candidates = lines.query(of)
+    of = prepared_geometry(of, prepared)
+    if candidates is not None:
+        return [k for k in candidates if of.touches(lines[k])]
+    return [k for k, line in enumerate(lines) if of.touches(line)]
     
 
 def bend_towards(line, where, to):
@@ -81,28 +437,134 @@ def bend_towards(line, where, to):
         raise ValueError('line does not contain the point where.')
         
     coords = line.coords[:]
-    # easy case: where is (within numeric precision) a vertex of line
-    for k, vertex in enumerate(coords):
-        if where.almost_equals(Point(vertex)):
-            # move coordinates of the vertex to destination
-            coords[k] = to.coords[0]
-            return LineString(coords)
-    
-    # hard case: where lies between vertices of line, so
-    # find nearest vertex and move that one to point to
+    if where.geom_type == 'Point':
+        # distances to all vertices from plain coordinates, without
+        # creating a Point object per vertex
+        x, y = where.coords[0][:2]
+        distances = [math.hypot(vertex[0] - x, vertex[1] - y) 
+                     for vertex in coords]
+        
+        # easy case: where is (within numeric precision) a vertex of line;
+        # hard case: where lies between vertices, so take nearest vertex
+        for k, distance in enumerate(distances):
+            if distance <= _ALMOST_EQUAL:
+                break
+        else:
+            k = min(range(len(distances)), key=distances.__getitem__)
+        coords[k] = to.coords[0]
+        return LineString(coords)
+    
+    # where is not a single point (e.g. a MultiPoint intersection), so
+    # move the vertex nearest to any part of it
     _, min_k = min((where.distance(Point(vertex)), k) 
                            for k, vertex in enumerate(coords))
     coords[min_k] = to.coords[0]
     return LineString(coords)
 
 
-def snappy_endings(lines, max_distance):
+def bend_towards_many(lines, moves, tolerance=None):
+    """Move many vertices like bend_towards, rebuilding each line only once.
+    
+    For each move, the vertex to move is determined on the coordinate 
+    arrays of all lines at once: the first vertex within numeric precision
+    of where or, if there is none, the vertex nearest to where. Vertices
+    are chosen on the original lines, i.e. independent of the other moves;
+    if several moves choose the same vertex, the last one wins. Z 
+    coordinates are dropped from modified lines.
+    
+    Args:
+        lines: list of LineStrings or a LineIndex
+        moves: list of tuples (line_id, where, to) of a position in lines 
+               (or a LineIndex id), a point on that line and the 
+               destination; where and to are Points or coordinate tuples
+        tolerance: optional maximum distance of where from its line 
+                   (default: 1e-9 times the extent of the moved lines)
+    
+    Returns:
+        list of lines with all modified lines replaced; for a LineIndex,
+        the index itself, which is updated in place
+        
+    Raises:
+        ValueError if a point where is not on its line
+    """
+    moves = list(moves)
+    if not moves:
+        return lines if isinstance(lines, LineIndex) else list(lines)
+    
+    def xy(point):
+        return point.coords[0][:2] if hasattr(point, 'coords') else point[:2]
+    
+    line_ids = [line_id for line_id, _, _ in moves]
+    where = np.array([xy(point) for _, point, _ in moves], dtype=float)
+    to = np.array([xy(point) for _, _, point in moves], dtype=float)
+    
+    # pack each affected line once
+    unique_ids = sorted(set(line_ids))
+    position = dict((line_id, k) for k, line_id in enumerate(unique_ids))
+    coords, offsets = pack_lines([lines[line_id] for line_id in unique_ids])
+    line_of_move = np.array([position[line_id] for line_id in line_ids])
+    
+    # all (move, vertex) pairs, grouped by move
+    counts = np.diff(offsets)[line_of_move]
+    move = np.repeat(np.arange(len(moves)), counts)
+    local = _ragged_arange(counts)
+    vertex = offsets[line_of_move][move] + local
+    distance = np.hypot(*(coords[vertex] - where[move]).T)
+    
+    # where must lie on its line: check distance to the line's segments
+    if tolerance is None:
+        tolerance = 1e-9 * max(np.ptp(coords, axis=0).max(), 1.0)
+    min_distance = np.full(len(moves), np.inf)
+    np.minimum.at(min_distance, move, distance)
+    is_segment = local < counts[move] - 1
+    a, b = coords[vertex[is_segment]], coords[vertex[is_segment] + 1]
+    p = where[move[is_segment]]
+    ab = b - a
+    length_sq = (ab ** 2).sum(axis=1)
+    t = np.clip(((p - a) * ab).sum(axis=1) / np.where(length_sq > 0, length_sq, 1),
+                0, 1)
+    np.minimum.at(min_distance, move[is_segment],
+                  np.hypot(*(a + t[:, np.newaxis] * ab - p).T))
+    if (min_distance > tolerance).any():
+        raise ValueError('line does not contain the point where.')
+    
+    # per move, the first vertex within precision, otherwise the nearest
+    score = np.where(distance <= _ALMOST_EQUAL, -1.0, distance)
+    order = np.lexsort((local, score, move))
+    chosen = vertex[order[np.cumsum(counts) - counts]]
+    
+    # apply moves; for moves of the same vertex, keep the last one
+    _, last = np.unique(chosen[::-1], return_index=True)
+    keep = len(moves) - 1 - last
+    coords[chosen[keep]] = to[keep]
+    
+    bent = [(line_id, LineString(coords[offsets[k]:offsets[k + 1]]))
+            for k, line_id in enumerate(unique_ids)]
+    if isinstance(lines, LineIndex):
+        for line_id, line in bent:
+            lines.update(line_id, line)
+        return lines
+    lines = [line for line in lines] # converts MultiLineString to list
+    for line_id, line in bent:
+        lines[line_id] = line
+    return lines
+
+
+def snappy_endings(lines, max_distance, prepared=False):
     """Snap endpoints of lines together if they are at most max_length apart.
     
     Args:
-        lines: a list of LineStrings or a MultiLineString
+        lines: a list of LineStrings, a MultiLineString or a LineIndex
         max_distance: maximum distance two endpoints may be joined together 
+        prepared: optional (default: False) True or a PreparedCache to test
+                  endpoints against prepared versions of the lines
+    
+    Returns:
+        list of snapped LineStrings; for a LineIndex, the index itself, 
+        which is updated in place
     """
+    if isinstance(lines, LineIndex):
+        return _snappy_endings_index(lines, max_distance, prepared)
     
     # initialize snapped lines with list of original lines
     # snapping points is a MultiPoint object of all vertices
@@ -110,7 +572,7 @@ def snappy_endings(lines, max_distance):
     snapping_points = vertices_from_lines(snapped_lines)
     
     # isolated endpoints are going to snap to the closest vertex
-    isolated_endpoints = find_isolated_endpoints(snapped_lines)    
+    isolated_endpoints = find_isolated_endpoints(snapped_lines, prepared)
     
     # only move isolated endpoints, one by one
     for endpoint in isolated_endpoints:
@@ -124,7 +586,7 @@ def snappy_endings(lines, max_distance):
         
         # find the LineString to modify within snapped_lines and update it        
         for i, snapped_line in enumerate(snapped_lines):
-            if endpoint.touches(snapped_line):
+            if prepared_geometry(snapped_line, prepared).touches(endpoint):
                 snapped_lines[i] = bend_towards(snapped_line, where=endpoint, 
                                                 to=target)
                 break
@@ -141,6 +603,64 @@ def snappy_endings(lines, max_distance):
     return snapped_lines
     
     
+def _snappy_endings_index(index, max_distance, prepared):
+    """snappy_endings for a LineIndex, using a grid to find nearby vertices.
+    
+    Follows the steps of the list version, but passes only the snapping 
+    points of the grid cells around an endpoint to nearest_neighbor_within.
+    """
+    snapping_points = vertices_from_lines(list(index))
+    cell_size = max_distance if max_distance > 0 else 1.0
+    
+    def cell_of(point):
+        x, y = point.coords[0][:2]
+        return int(x // cell_size), int(y // cell_size)
+    
+    cells = {} # (ix, iy) -> positions in snapping_points
+    for k, snapping_point in enumerate(snapping_points):
+        cells.setdefault(cell_of(snapping_point), []).append(k)
+    
+    for endpoint in find_isolated_endpoints(index, prepared):
+        # snapping points in all cells overlapping the search region, in 
+        # their list order, so that ties are resolved as in the list version
+        minx, miny, maxx, maxy = endpoint.buffer(max_distance).bounds
+        nearby = sorted(k for ix in range(int(minx // cell_size), 
+                                          int(maxx // cell_size) + 1)
+                          for iy in range(int(miny // cell_size), 
+                                          int(maxy // cell_size) + 1)
+                          for k in cells.get((ix, iy), ()))
+        target = None
+        if nearby:
+            target = nearest_neighbor_within(
+                [snapping_points[k] for k in nearby], endpoint, max_distance)
+        
+        # do nothing if no target point to snap to is found
+        if not target:
+            continue
+        
+        # the first line the endpoint touches, i.e. that ends there and is 
+        # not closed
+        for i in index.lines_ending_at(endpoint):
+            if index[i].coords[0] != index[i].coords[-1]:
+                index.update(i, bend_towards(index[i], where=endpoint, 
+                                             to=target))
+                break
+        
+        # also update the corresponding snapping_points
+        for k in sorted(cells.get(cell_of(endpoint), ())):
+            if endpoint.equals(snapping_points[k]):
+                cells[cell_of(endpoint)].remove(k)
+                cells.setdefault(cell_of(target), []).append(k)
+                snapping_points[k] = target
+                break
+    
+    # post-processing: remove any resulting lines of length 0
+    for i in index.ids():
+        if index[i].length == 0:
+            index.delete(i)
+    return index
+
+
 def nearest_neighbor_within(others, point, max_distance):
     """Find nearest point among others up to a maximum distance.
     
@@ -159,35 +679,54 @@ def nearest_neighbor_within(others, point, max_distance):
         closest_point = None
     elif isinstance(interesting_points, Point):
         closest_point = interesting_points
-    else:            
-        distances = [point.distance(ip) for ip in interesting_points
-                     if point.distance(ip) > 0]
-        closest_point = interesting_points[distances.index(min(distances))]
+    else:
+        # point itself may be among others; skip it
+        candidates = [ip for ip in interesting_points.geoms
+                      if point.distance(ip) > 0]
+        closest_point = min(candidates, key=point.distance)
     
     return closest_point
 
 
-def find_isolated_endpoints(lines):
+def find_isolated_endpoints(lines, prepared=False):
     """Find endpoints of lines that don't touch another line.
     
     Args:
-        lines: a list of LineStrings or a MultiLineString
+        lines: a list of LineStrings, a MultiLineString or a LineIndex
+        prepared: optional (default: False) True or a PreparedCache to test
+                  endpoints against prepared versions of the lines
         
     Returns:
         A list of line end Points that don't touch any other line of lines
     """
-        
-    isolated_endpoints = []
-    for i, line in enumerate(lines):
-        other_lines = lines[:i] + lines[i+1:]
-        for q in [0,-1]:
-            endpoint = Point(line.coords[q])
-            if any(endpoint.touches(another_line) 
-                   for another_line in other_lines):
-                continue
-            else:
-                isolated_endpoints.append(endpoint)
-    return isolated_endpoints
+    if isinstance(lines, LineIndex):
+        # a Point only touches a LineString at its boundary, i.e. at the 
+        # endpoints of a line that is not closed, so the endpoint index of
+        # the LineIndex answers this without any predicate calls
+        isolated_endpoints = []
+        for i in lines.ids():
+            for q in [0, -1]:
+                endpoint = Point(lines[i].coords[q])
+                if not any(j != i and lines[j].coords[0] != lines[j].coords[-1]
+                           for j in lines.lines_ending_at(endpoint)):
+                    isolated_endpoints.append(endpoint)
+        return isolated_endpoints
+    
+    lines = [line for line in lines] # converts MultiLineString to list
+    endpoints = [(i, Point(line.coords[q])) 
+                 for i, line in enumerate(lines) for q in [0, -1]]
+    touching = [False] * len(endpoints)
+    
+    # test each line against all endpoints of the other lines, so that each
+    # (prepared) line is used for a whole batch of tests in a row
+    for j, another_line in enumerate(lines):
+        another_line = prepared_geometry(another_line, prepared)
+        for k, (i, endpoint) in enumerate(endpoints):
+            if i != j and not touching[k] and another_line.touches(endpoint):
+                touching[k] = True
+    
+    return [endpoint for (_, endpoint), touches in zip(endpoints, touching)
+            if not touches]
     
 def closest_object(geometries, point):
     """Find the nearest geometry among a list, measured from fixed point.
@@ -205,8 +744,309 @@ def closest_object(geometries, point):
                               for (k, geom) in enumerate(geometries))
     
     return geometries[min_index], min_dist, min_index
+
+
+def closest_objects(geometries, points, k=1, max_distance=None):
+    """Find the k nearest geometries and/or those within max_distance.
+
+    The bounding boxes of the geometries are stored in a uniform grid. For
+    each point, rings of cells around it are searched until no geometry in
+    the remaining cells can be closer than the k-th best distance found so 
+    far (or max_distance). Exact distances are only computed for candidates
+    whose bounding box distance, a lower bound of the exact distance, does
+    not rule them out. Ties are resolved by the lower index.
+
+    Args:
+        geometries: a list of shapely geometry objects
+        points: array of shape (N, 2) or list of Points
+        k: optional number of nearest geometries per point (default: 1);
+           None for all geometries within max_distance
+        max_distance: optional maximum distance of returned geometries
+
+    Returns:
+        list with one entry per point: a list of up to k tuples
+        (index, distance), sorted by distance, so that geometries[index]
+        is at distance from the point
+    """
+    if k is None and max_distance is None:
+        raise ValueError('At least one of k and max_distance is needed.')
+
+    points = np.array([p.coords[0][:2] if hasattr(p, 'coords') else p
+                       for p in points], dtype=float).reshape(-1, 2)
+    bounds = np.array([geom.bounds for geom in geometries],
+                      dtype=float).reshape(-1, 4)
+    # empty geometries have no (or NaN) bounds and are never returned
+    ids = np.flatnonzero(np.isfinite(bounds).all(axis=1))
+    if len(ids) == 0 or len(points) == 0:
+        return [[] for _ in points]
+    bounds, ids = bounds[ids], ids.tolist()
+
+    grid = _segment_grid(bounds[:, :2], bounds[:, 2:], points)
+    extent = np.median(np.maximum(bounds[:, 2] - bounds[:, 0],
+                                  bounds[:, 3] - bounds[:, 1]))
+    if extent > grid['cell_size']:
+        # cells should fit the typical box, else it is registered in many
+        grid = _segment_grid(bounds[:, :2], bounds[:, 2:], points, extent)
+    origin, cell_size = grid['origin'], float(grid['cell_size'])
+    ptr, cell_boxes = grid['ptr'], grid['segments']
+
+    limit = np.inf if max_distance is None else max_distance
+    # slack for comparing bounding box distances with GEOS distances, which
+    # may differ in the last bits
+    tolerance = 1e-9 * max(np.ptp(np.vstack([bounds[:, :2], bounds[:, 2:],
+                                             points]), axis=0).max(), 1.0)
+    visited = np.zeros(len(bounds), dtype=bool)
+    results = []
+    for x, y in points:
+        point = Point(x, y)
+        ix, iy = np.floor(([x, y] - origin) / cell_size).astype(np.int64)
+        best = [] # max-heap of the k best (-distance, -index) so far
+        found = [] # all (index, distance) within limit, if k is None
+        bound = limit
+        seen = []
+        r = 0
+        while True:
+            pos, exhausted = _ring_cells(grid, ix, iy, r)
+            if exhausted:
+                break
+            if len(pos):
+                candidates = np.unique(np.concatenate(
+                    [cell_boxes[ptr[q]:ptr[q + 1]] for q in pos]))
+                candidates = candidates[~visited[candidates]]
+                visited[candidates] = True
+                seen.append(candidates)
+
+                # distance to bounding box: zero inside, else to nearest side
+                box = bounds[candidates]
+                dx = np.maximum(np.maximum(box[:, 0] - x, x - box[:, 2]), 0)
+                dy = np.maximum(np.maximum(box[:, 1] - y, y - box[:, 3]), 0)
+                lower = np.hypot(dx, dy)
+                order = np.lexsort((candidates, lower))
+                for j, lower_j in zip(candidates[order].tolist(),
+                                      lower[order].tolist()):
+                    if lower_j > bound + tolerance:
+                        break
+                    d = point.distance(geometries[ids[j]])
+                    if k is None:
+                        if d <= limit:
+                            found.append((ids[j], d))
+                    elif len(best) < k:
+                        heapq.heappush(best, (-d, -j))
+                        if len(best) == k:
+                            bound = min(-best[0][0], limit)
+                    elif (d, j) < (-best[0][0], -best[0][1]):
+                        heapq.heapreplace(best, (-d, -j))
+                        bound = min(-best[0][0], limit)
+            # boxes in cells beyond ring r are at least r cells away
+            if bound + tolerance < r * cell_size:
+                break
+            r += 1
+
+        for candidates in seen:
+            visited[candidates] = False
+        if k is not None:
+            found = [(ids[-j], -d) for d, j in best if -d <= limit]
+        results.append(sorted(found, key=lambda item: (item[1], item[0])))
+    return results
+
+
+def _ring_cells(grid, ix, iy, r):
+    """Find occupied cells with Chebyshev distance r from cell (ix, iy).
+    
+    Returns:
+        Tuple (pos, exhausted) of the positions of the cells in grid['keys']
+        and whether the ring lies completely outside the grid, i.e. all 
+        cells were searched before
+    """
+    nx, ny = grid['shape']
+    keys = grid['keys']
+    if r == 0:
+        cx, cy = np.array([ix]), np.array([iy])
+    else:
+        side = np.arange(-r, r + 1)
+        inner = np.arange(-r + 1, r)
+        cx = ix + np.concatenate([side, side, 
+                                  np.full(len(inner), -r), 
+                                  np.full(len(inner), r)])
+        cy = iy + np.concatenate([np.full(len(side), -r), 
+                                  np.full(len(side), r), 
+                                  inner, inner])
+    valid = (cx >= 0) & (cx < nx) & (cy >= 0) & (cy < ny)
+    if not valid.any() and r > max(nx, ny):
+        return np.zeros(0, dtype=np.int64), True
+    cell_keys = cx[valid] * ny + cy[valid]
+    pos = np.searchsorted(keys, cell_keys)
+    found = pos < len(keys)
+    found[found] = keys[pos[found]] == cell_keys[found]
+    return pos[found], False
+
+
+def _segment_grid(starts, ends, points, cell_size=None):
+    """Build a uniform grid index of segments, covering points, too.
+    
+    Returns:
+        dict of arrays: origin, cell_size, shape (number of cells in x and 
+        y), keys (sorted occupied cell keys), ptr (start of each cell's entry
+        in segments, plus end) and segments (segment indices per cell)
+    """
+    seg_min, seg_max = np.minimum(starts, ends), np.maximum(starts, ends)
+    lower = np.minimum(seg_min.min(axis=0), points.min(axis=0))
+    upper = np.maximum(seg_max.max(axis=0), points.max(axis=0))
+    if cell_size is None:
+        # aim for a few segments per cell on average
+        area = max(np.prod(upper - lower), 1e-12)
+        cell_size = np.sqrt(4 * area / len(starts))
+        if not cell_size > 0:
+            cell_size = 1.0
+    shape = np.floor((upper - lower) / cell_size).astype(np.int64) + 1
+    
+    i0 = np.floor((seg_min - lower) / cell_size).astype(np.int64)
+    i1 = np.floor((seg_max - lower) / cell_size).astype(np.int64)
+    nx = i1[:, 0] - i0[:, 0] + 1
+    cells_per_segment = nx * (i1[:, 1] - i0[:, 1] + 1)
+    segment = np.repeat(np.arange(len(starts)), cells_per_segment)
+    k = _ragged_arange(cells_per_segment)
+    key = ((i0[segment, 0] + k % nx[segment]) * shape[1] + 
+           i0[segment, 1] + k // nx[segment])
+    
+    order = np.argsort(key, kind='mergesort')
+    key, segment = key[order], segment[order]
+    keys, first = np.unique(key, return_index=True)
+    return {'origin': lower, 'cell_size': np.array(cell_size), 'shape': shape,
+            'keys': keys, 'ptr': np.append(first, len(key)), 
+            'segments': segment}
+
+
+def _query_segment_grid(grid, starts, ends, segment_line, points):
+    """Find nearest segment for each point by searching rings of cells.
+    
+    Rings of cells around the cell of a point are searched until the best 
+    distance found is not greater than the distance to the next ring.
+    
+    Returns:
+        Tuple (line, distance, nearest) of the nearest line's index, the 
+        distance and the nearest point on it for each point
+    """
+    origin, cell_size = grid['origin'], float(grid['cell_size'])
+    ptr, cell_segments = grid['ptr'], grid['segments']
+    
+    num_points = len(points)
+    best_line = np.full(num_points, -1, dtype=np.int64)
+    best_dist = np.full(num_points, np.inf)
+    best_point = np.full((num_points, 2), np.nan)
+    
+    for n, point in enumerate(points):
+        ix, iy = np.floor((point - origin) / cell_size).astype(np.int64)
+        r = 0
+        while True:
+            pos, exhausted = _ring_cells(grid, ix, iy, r)
+            if exhausted:
+                break # searched whole grid
+            if len(pos):
+                candidates = np.concatenate(
+                    [cell_segments[ptr[q]:ptr[q + 1]] for q in pos])
+                a, b = starts[candidates], ends[candidates]
+                d = b - a
+                length2 = (d ** 2).sum(axis=1)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    t = np.where(length2 > 0, 
+                                 ((point - a) * d).sum(axis=1) / length2, 0)
+                t = np.clip(t, 0, 1)
+                projected = a + t[:, np.newaxis] * d
+                dist = np.hypot(*(projected - point).T)
+                # smallest distance, ties resolved by lowest line index
+                best = np.lexsort((segment_line[candidates], dist))[0]
+                line = segment_line[candidates[best]]
+                if dist[best] < best_dist[n] or \
+                   (dist[best] == best_dist[n] and line < best_line[n]):
+                    best_dist[n] = dist[best]
+                    best_line[n] = line
+                    best_point[n] = projected[best]
+            if best_dist[n] <= r * cell_size:
+                break
+            r += 1
+    return best_line, best_dist, best_point
+
+
+# per-process cache of memory-mapped arrays used by _closest_lines_worker
+_mapped_arrays = {}
+
+
+def _closest_lines_worker(args):
+    """Pool worker for closest_lines: query a chunk of points."""
+    directory, points = args
+    if directory not in _mapped_arrays:
+        _mapped_arrays.clear()
+        _mapped_arrays[directory] = dict(
+            (name[:-4], np.load(os.path.join(directory, name), mmap_mode='r'))
+            for name in os.listdir(directory) if name.endswith('.npy'))
+    arrays = _mapped_arrays[directory]
+    grid = dict((name[5:], array) for name, array in arrays.items()
+                if name.startswith('grid_'))
+    return _query_segment_grid(grid, arrays['starts'], arrays['ends'], 
+                               arrays['segment_line'], points)
+
+
+def closest_lines(lines, points, workers=1, cell_size=None, chunksize=10000):
+    """Find the nearest line for many points using a grid index.
+    
+    Lines are split into segments, which are registered in a uniform grid.
+    With workers > 1, segment coordinates and grid are written once to 
+    memory-mapped files in a temporary directory, so that a process pool 
+    can share them; only chunks of points are sent to the workers.
+    
+    Args:
+        lines: a list of LineStrings or a MultiLineString
+        points: array of shape (N, 2) or list of Points
+        workers: optional number of processes (default: 1, no pool)
+        cell_size: optional grid cell size (default: derived from extent
+                   and number of segments)
+        chunksize: optional number of points per task
+    
+    Returns:
+        Tuple (line, distance, nearest) of integer array of indices into 
+        lines, array of distances and array of shape (N, 2) with the 
+        nearest point on the nearest line for each point
+    """
+    points = np.array([p.coords[0][:2] if hasattr(p, 'coords') else p 
+                       for p in points], dtype=float).reshape(-1, 2)
+    coords, offsets = pack_lines(lines)
+    
+    is_segment = np.ones(max(len(coords) - 1, 0), dtype=bool)
+    line_ends = offsets[1:-1] - 1
+    is_segment[line_ends[(line_ends >= 0) & (line_ends < len(is_segment))]] = False
+    segment_index = np.nonzero(is_segment)[0]
+    if len(segment_index) == 0 or len(points) == 0:
+        raise ValueError('closest_lines needs at least one line and point.')
+    starts, ends = coords[segment_index], coords[segment_index + 1]
+    segment_line = np.searchsorted(offsets, segment_index, side='right') - 1
+    grid = _segment_grid(starts, ends, points, cell_size)
+    
+    if workers <= 1:
+        return _query_segment_grid(grid, starts, ends, segment_line, points)
     
+    directory = tempfile.mkdtemp(prefix='closest_lines_')
+    try:
+        arrays = {'starts': starts, 'ends': ends, 
+                  'segment_line': segment_line}
+        arrays.update(('grid_' + name, array) for name, array in grid.items())
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+        
+        tasks = [(directory, points[start:start + chunksize])
+                 for start in range(0, len(points), chunksize)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_closest_lines_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
     
+    return tuple(np.concatenate(parts) for parts in zip(*results))
+
+
 def project_point_to_line(point, line_start, line_end):
     """Find nearest point on a straight line, measured from given point.
     
@@ -306,37 +1146,58 @@ def project_point_to_object(point, geometry):
     return nearest_point
     
 
-def one_linestring_per_intersection(lines):
+def one_linestring_per_intersection(lines, cell_size=None, workers=1):
     """ Move line endpoints to intersections of line segments.
     
     Given a list of touching or possibly intersecting LineStrings, return a
     list LineStrings that have their endpoints at all crossings and
     intersecting points and ONLY there.
     
+    By default, the whole network is noded in a single GEOS operation. For 
+    big networks, that may run out of memory; then specify a cell_size to 
+    node on a grid instead (see node_and_merge_grid).
+    
     Args:
-        a list of LineStrings or a MultiLineString
+        lines: a list of LineStrings, a MultiLineString or a LineIndex
+        cell_size: optional grid cell size for partitioned noding 
+        workers: optional number of processes for partitioned noding
         
     Returns:
-        a list of LineStrings
+        a list of LineStrings; for a LineIndex, the index itself, whose 
+        lines are replaced by the result
     """
+    if isinstance(lines, LineIndex):
+        result = one_linestring_per_intersection(list(lines), cell_size, 
+                                                 workers)
+        lines.clear()
+        for line in result:
+            lines.insert(line)
+        return lines
+    
+    if cell_size is not None:
+        return node_and_merge_grid(lines, cell_size, workers=workers)
+    
     lines_merged = shapely.ops.linemerge(lines)
 
     # intersecting multiline with its bounding box somehow triggers a first
     bounding_box = box(*lines_merged.bounds)
 
     # perform linemerge (one linestring between each crossing only)
-    # if this fails, write function to perform this on a bbox-grid and then
-    # merge the result
+    # if this fails, use argument cell_size to perform this on a bbox-grid 
+    # and then merge the result
     lines_merged = lines_merged.intersection(bounding_box)
     lines_merged = shapely.ops.linemerge(lines_merged)
-    return lines_merged
+    if hasattr(lines_merged, 'geoms'):
+        return list(lines_merged.geoms)
+    return [lines_merged] # a single LineString
 
 
 def linemerge(linestrings_or_multilinestrings):
     """ Merge list of LineStrings and/or MultiLineStrings.
     
     Given a list of LineStrings and possibly MultiLineStrings, merge all of
-    them to a single MultiLineString.
+    them to a single MultiLineString. For big or streamed inputs, see
+    iter_linemerge.
     
     Args:
         list of LineStrings and/or MultiLineStrings
@@ -355,3 +1216,729 @@ def linemerge(linestrings_or_multilinestrings):
         
     return shapely.ops.linemerge(lines)
     
+
+
+def pack_lines(lines, keep_z=False):
+    """Pack the coordinates of many LineStrings into a single array.
+    
+    The noding, merging and simplification functions working on packed 
+    coordinates are 2D only, so by default Z coordinates are dropped.
+    
+    Args:
+        lines: a list of LineStrings or a MultiLineString
+        keep_z: optional (default: False) if True and any line has Z 
+                coordinates, keep them as third column (0 for lines 
+                without Z)
+        
+    Returns:
+        Tuple (coords, offsets) of a float array of shape (N, 2) (or (N, 3))
+        and an integer array of length len(lines) + 1, so that the 
+        coordinates of lines[k] are coords[offsets[k]:offsets[k+1]]
+    """
+    if hasattr(lines, 'geoms'):
+        lines = lines.geoms
+    coord_arrays = [np.asarray(line.coords, dtype=float) for line in lines]
+    if keep_z and any(c.shape[1] > 2 for c in coord_arrays):
+        dims = 3
+        coord_arrays = [c if c.shape[1] == 3 
+                        else np.column_stack([c, np.zeros(len(c))])
+                        for c in coord_arrays]
+    else:
+        dims = 2
+        coord_arrays = [c[:, :2] for c in coord_arrays]
+    offsets = np.zeros(len(coord_arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in coord_arrays])
+    
+    if coord_arrays:
+        coords = np.concatenate(coord_arrays)
+    else:
+        coords = np.zeros((0, dims))
+    return coords, offsets
+
+
+def unpack_lines(coords, offsets):
+    """Create list of LineStrings from packed coordinates (see pack_lines)."""
+    return [LineString(coords[start:end]) 
+            for start, end in pairs(offsets) if end - start > 1]
+
+
+def _ragged_arange(counts):
+    """Return concatenated ranges 0..counts[k]-1 for all k as one array."""
+    counts = np.asarray(counts, dtype=np.int64)
+    group_starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(group_starts, counts)
+
+
+def grid_candidate_pairs(bounds, other_bounds=None, cell_size=None):
+    """Find pairs of overlapping bounding boxes using a uniform grid.
+    
+    Each box is registered in all grid cells it covers. Only boxes sharing
+    a cell are compared, so the cost grows roughly linear with the number of
+    boxes, instead of quadratically for a comparison of all pairs.
+    
+    Args:
+        bounds: array of shape (N, 4) with (minx, miny, maxx, maxy) rows
+        other_bounds: optional array of shape (M, 4); if omitted, pairs of
+                      overlapping boxes within bounds are returned
+        cell_size: optional edge length of the grid cells (default: median
+                   extent of the boxes, the bigger one of both sets)
+                   
+    Returns:
+        Tuple (i, j) of integer arrays, so that bounds[i] overlaps 
+        other_bounds[j]. If other_bounds is omitted, bounds[i] overlaps 
+        bounds[j] with i < j. Pairs are sorted by (i, j).
+    """
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    self_join = other_bounds is None
+    if self_join:
+        other_bounds = bounds
+        all_bounds = bounds
+    else:
+        other_bounds = np.asarray(other_bounds, dtype=float).reshape(-1, 4)
+        all_bounds = np.vstack([bounds, other_bounds])
+    
+    n, m = len(bounds), len(other_bounds)
+    if n == 0 or m == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    
+    if cell_size is None:
+        # e.g. points vs. polygons: cells should fit the bigger boxes
+        cell_size = max(np.median(np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1]))
+                        for b in (bounds, other_bounds))
+        if not cell_size > 0:
+            # only points or zero-length lines: derive from total extent
+            total_extent = max(all_bounds[:, 2].max() - all_bounds[:, 0].min(),
+                               all_bounds[:, 3].max() - all_bounds[:, 1].min())
+            cell_size = total_extent / np.sqrt(len(all_bounds))
+            if not cell_size > 0:
+                cell_size = 1.0
+    
+    # grid cell ranges covered by each box
+    origin_x, origin_y = all_bounds[:, 0].min(), all_bounds[:, 1].min()
+    ix0 = np.floor((all_bounds[:, 0] - origin_x) / cell_size).astype(np.int64)
+    iy0 = np.floor((all_bounds[:, 1] - origin_y) / cell_size).astype(np.int64)
+    ix1 = np.floor((all_bounds[:, 2] - origin_x) / cell_size).astype(np.int64)
+    iy1 = np.floor((all_bounds[:, 3] - origin_y) / cell_size).astype(np.int64)
+    nx = ix1 - ix0 + 1
+    
+    # one entry per (box, covered cell)
+    cells_per_box = nx * (iy1 - iy0 + 1)
+    owner = np.repeat(np.arange(len(all_bounds)), cells_per_box)
+    k = _ragged_arange(cells_per_box)
+    cell = ((ix0[owner] + k % nx[owner]) * (iy1.max() + 1) +
+            iy0[owner] + k // nx[owner])
+    side = (owner >= n).astype(np.int64) if not self_join else 0 * owner
+    
+    # sort entries by cell (and side within cell), then find group limits
+    order = np.lexsort((side, cell))
+    cell, owner, side = cell[order], owner[order], side[order]
+    positions = np.arange(len(cell))
+    is_group_start = np.ones(len(cell), dtype=bool)
+    is_group_start[1:] = cell[1:] != cell[:-1]
+    group_starts = np.nonzero(is_group_start)[0]
+    group_ends = np.append(group_starts[1:], len(cell))
+    group_id = np.cumsum(is_group_start) - 1
+    
+    # each entry is paired with a contiguous range of partners in its group
+    if self_join:
+        partner_start = positions + 1
+    else:
+        first_side_entries = np.bincount(group_id, weights=1 - side)
+        partner_start = (group_starts + 
+                         first_side_entries.astype(np.int64))[group_id]
+        partner_start[side == 1] = group_ends[group_id][side == 1]
+    partner_counts = group_ends[group_id] - partner_start
+    
+    left = np.repeat(positions, partner_counts)
+    right = np.repeat(partner_start, partner_counts) + \
+            _ragged_arange(partner_counts)
+    i, j = owner[left], owner[right]
+    if self_join:
+        i, j = np.minimum(i, j), np.maximum(i, j)
+    else:
+        j = j - n
+    
+    # boxes sharing several cells yield duplicate pairs
+    keys = np.unique(i * m + j)
+    i, j = keys // m, keys % m
+    
+    # sharing a cell does not imply overlapping boxes
+    a, b = bounds[i], other_bounds[j]
+    overlap = ((a[:, 0] <= b[:, 2]) & (b[:, 0] <= a[:, 2]) &
+               (a[:, 1] <= b[:, 3]) & (b[:, 1] <= a[:, 3]))
+    return i[overlap], j[overlap]
+
+
+def curve_order(bounds, curve='hilbert', bits=16):
+    """Order bounding boxes along a space-filling curve.
+
+    The box centers are scaled to a 2**bits by 2**bits grid over the total
+    extent and ordered by their distance along the curve. Boxes close to
+    each other in space then mostly end up close to each other in order.
+
+    Args:
+        bounds: array of shape (N, 4) with (minx, miny, maxx, maxy) rows
+        curve: optional, either 'hilbert' (default) or 'zorder'
+        bits: optional grid resolution per axis in bits (at most 31)
+
+    Returns:
+        integer array of N positions, i.e. bounds[order] is sorted
+    """
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    if len(bounds) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    centers = (bounds[:, :2] + bounds[:, 2:]) / 2
+    lower = centers.min(axis=0)
+    extent = (centers.max(axis=0) - lower).max()
+    side = 2 ** bits
+    if extent > 0:
+        scaled = np.floor((centers - lower) / extent * (side - 1))
+    else:
+        scaled = np.zeros_like(centers)
+    x, y = scaled[:, 0].astype(np.int64), scaled[:, 1].astype(np.int64)
+
+    distance = np.zeros(len(bounds), dtype=np.int64)
+    if curve == 'hilbert':
+        s = side // 2
+        while s > 0:
+            rx = (x & s) > 0
+            ry = (y & s) > 0
+            distance += s * s * ((3 * rx) ^ ry)
+            # rotate quadrant, so that the curve pieces connect
+            flip = ~ry & rx
+            x = np.where(flip, side - 1 - x, x)
+            y = np.where(flip, side - 1 - y, y)
+            x, y = np.where(ry, x, y), np.where(ry, y, x)
+            s //= 2
+    elif curve == 'zorder':
+        # interleave bits of x and y
+        for bit in range(bits):
+            distance |= ((x >> bit) & 1) << (2 * bit)
+            distance |= ((y >> bit) & 1) << (2 * bit + 1)
+    else:
+        raise ValueError("Unknown curve '{}'.".format(curve))
+
+    return np.argsort(distance, kind='mergesort')
+
+
+def _segment_split_points(starts, ends, i, j, eps=1e-12):
+    """Find where the segment pairs (i, j) must be split to node them.
+    
+    Handles proper crossings, endpoints lying on the other segment and 
+    collinear overlaps. Split points that coincide with a segment endpoint 
+    reuse that endpoint's exact coordinates, so that all segments meeting 
+    there yield identical node coordinates.
+    
+    Returns:
+        Tuple (segment, t, points) of segment indices, relative position 
+        0 < t < 1 along that segment and split point coordinates
+    """
+    p, q = starts[i], starts[j]
+    r, s = ends[i] - p, ends[j] - q
+    qp = q - p
+    
+    denom = r[:, 0] * s[:, 1] - r[:, 1] * s[:, 0]
+    cross_qp_s = qp[:, 0] * s[:, 1] - qp[:, 1] * s[:, 0]
+    cross_qp_r = qp[:, 0] * r[:, 1] - qp[:, 1] * r[:, 0]
+    r_len2 = (r ** 2).sum(axis=1)
+    s_len2 = (s ** 2).sum(axis=1)
+    
+    parallel = np.abs(denom) <= eps * np.sqrt(r_len2 * s_len2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(parallel, -1.0, cross_qp_s / denom)
+        u = np.where(parallel, -1.0, cross_qp_r / denom)
+    
+    # non-parallel segments: crossings and T-junctions
+    hit = (~parallel & (t >= -eps) & (t <= 1 + eps) & 
+                       (u >= -eps) & (u <= 1 + eps))
+    points = p + t[:, np.newaxis] * r
+    points = np.where((t <= eps)[:, np.newaxis], p, points)
+    points = np.where((t >= 1 - eps)[:, np.newaxis], ends[i], points)
+    points = np.where((u <= eps)[:, np.newaxis], q, points)
+    points = np.where((u >= 1 - eps)[:, np.newaxis], ends[j], points)
+    split_i = hit & (t > eps) & (t < 1 - eps)
+    split_j = hit & (u > eps) & (u < 1 - eps)
+    
+    segments = [i[split_i], j[split_j]]
+    params = [t[split_i], u[split_j]]
+    coords = [points[split_i], points[split_j]]
+    
+    # collinear segments: split each at the other's endpoints
+    collinear = (parallel & (r_len2 > 0) & (s_len2 > 0) &
+                 (np.abs(cross_qp_r) <= eps * r_len2))
+    for seg, origin, direction, length2, others in [
+            (i, p, r, r_len2, (starts[j], ends[j])),
+            (j, q, s, s_len2, (starts[i], ends[i]))]:
+        for other in others:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                param = ((other - origin) * direction).sum(axis=1) / length2
+            inside = collinear & (param > eps) & (param < 1 - eps)
+            segments.append(seg[inside])
+            params.append(param[inside])
+            coords.append(other[inside])
+    
+    return (np.concatenate(segments), np.concatenate(params), 
+            np.concatenate(coords))
+
+
+def _merge_chains(edge_u, edge_v, num_nodes, terminal=None):
+    """Merge edges of a graph to maximal chains between nodes of degree != 2.
+    
+    Args:
+        edge_u, edge_v: integer arrays of edge end nodes (parallel edges and 
+                        self-loops are allowed)
+        num_nodes: number of nodes in the graph
+        terminal: optional boolean array of nodes that always end a chain
+    
+    Returns:
+        list of tuples (nodes, edges) of node and edge index lists, so that 
+        edges[k] connects nodes[k] and nodes[k+1]; cycles of degree-2 nodes 
+        are returned as closed chains (first node == last node)
+    """
+    num_edges = len(edge_u)
+    degree = np.bincount(np.concatenate([edge_u, edge_v]), 
+                         minlength=num_nodes)
+    
+    # adjacency list in CSR form: incident edges of each node
+    ends = np.concatenate([edge_u, edge_v])
+    order = np.argsort(ends, kind='mergesort')
+    incident = np.concatenate([np.arange(num_edges)] * 2)[order].tolist()
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(degree)
+    indptr = indptr.tolist()
+    
+    # chains only pass through nodes of degree 2 that are not terminal
+    passable = degree == 2
+    if terminal is not None:
+        passable &= ~np.asarray(terminal, dtype=bool)
+    
+    u, v, passable = edge_u.tolist(), edge_v.tolist(), passable.tolist()
+    visited = [False] * num_edges
+    
+    def walk(node, edge):
+        nodes, edges = [node], []
+        while True:
+            visited[edge] = True
+            edges.append(edge)
+            node = v[edge] if u[edge] == node else u[edge]
+            nodes.append(node)
+            if not passable[node]:
+                break
+            first, second = incident[indptr[node]:indptr[node] + 2]
+            edge = second if first == edge else first
+            if visited[edge]:
+                break # cycle closed
+        return nodes, edges
+    
+    chains = []
+    for node in np.nonzero(~np.asarray(passable))[0].tolist():
+        for edge in incident[indptr[node]:indptr[node + 1]]:
+            if not visited[edge]:
+                chains.append(walk(node, edge))
+    
+    # remaining edges form cycles consisting of degree-2 nodes only
+    for edge in range(num_edges):
+        if not visited[edge]:
+            chains.append(walk(u[edge], edge))
+    return chains
+
+
+def _snap_nodes(nodes, preferred, tolerance):
+    """Map each node to a representative of its cluster of nearby nodes.
+    
+    Computed intersection points of several segments crossing at one point 
+    can differ by a few ulps. Nodes closer than tolerance are merged, where 
+    preferred nodes (e.g. original vertices) win over the others.
+    
+    Returns:
+        integer array, so that nodes[result] are the snapped coordinates
+    """
+    num_nodes = len(nodes)
+    padded_bounds = np.hstack([nodes - tolerance / 2, nodes + tolerance / 2])
+    i, j = grid_candidate_pairs(padded_bounds, cell_size=tolerance)
+    
+    priority = np.where(preferred, 0, num_nodes) + np.arange(num_nodes)
+    while len(i):
+        lowest = np.minimum(priority[i], priority[j])
+        if (priority[i] == lowest).all() and (priority[j] == lowest).all():
+            break
+        np.minimum.at(priority, i, lowest)
+        np.minimum.at(priority, j, lowest)
+    return priority % num_nodes
+
+
+def _isin_rows(a, b):
+    """Return boolean mask of rows of array a that also occur in array b."""
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros(len(a), dtype=bool)
+    _, index = np.unique(np.concatenate([a, b]), axis=0, return_inverse=True)
+    index = index.ravel()
+    in_b = np.zeros(index.max() + 1, dtype=bool)
+    in_b[index[len(a):]] = True
+    return in_b[index[:len(a)]]
+
+
+def _line_segments(coords, offsets):
+    """Return start and end coordinates of all segments of packed lines."""
+    is_segment = np.ones(max(len(coords) - 1, 0), dtype=bool)
+    line_ends = offsets[1:-1] - 1
+    is_segment[line_ends[(line_ends >= 0) & (line_ends < len(is_segment))]] = False
+    segment_index = np.nonzero(is_segment)[0]
+    return coords[segment_index], coords[segment_index + 1]
+
+
+def _segment_bounds(starts, ends):
+    """Return bounds array of shape (N, 4) of segments."""
+    return np.hstack([np.minimum(starts, ends), np.maximum(starts, ends)])
+
+
+def _merge_split_segments(coords, starts, ends, splits, tolerance=None, 
+                          fixed=None):
+    """Build the graph of split segments and merge it to lines.
+    
+    Args:
+        coords, starts, ends: packed coordinates and their segments
+        splits: tuple (segment, t, points) as from _segment_split_points
+        tolerance, fixed: see node_and_merge_coords
+    
+    Returns:
+        Tuple (coords, offsets) of the noded and merged lines
+    """
+    split_segment, split_t, split_points = splits
+    num_segments = len(starts)
+    
+    # all vertices (segment endpoints and split points) ordered along 
+    # segments; ties are ordered by coordinates, so that the result does not
+    # depend on the order in which split points were found
+    segment = np.concatenate([np.arange(num_segments), split_segment, 
+                              np.arange(num_segments)])
+    t = np.concatenate([np.zeros(num_segments), split_t, 
+                        np.ones(num_segments)])
+    points = np.concatenate([starts, split_points, ends])
+    is_vertex = np.ones(len(points), dtype=bool)
+    is_vertex[num_segments:num_segments + len(split_segment)] = False
+    order = np.lexsort((points[:, 1], points[:, 0], t, segment))
+    segment, points, is_vertex = segment[order], points[order], is_vertex[order]
+    
+    # (almost) identical coordinates become one node; consecutive vertices 
+    # on the same segment become an edge
+    nodes, node_index = np.unique(points, axis=0, return_inverse=True)
+    node_index = node_index.ravel()
+    if tolerance is None:
+        tolerance = 1e-9 * max(np.ptp(coords, axis=0).max(), 1.0)
+    node_is_vertex = np.zeros(len(nodes), dtype=bool)
+    node_is_vertex[node_index[is_vertex]] = True
+    node_index = _snap_nodes(nodes, node_is_vertex, tolerance)[node_index]
+    same_segment = segment[1:] == segment[:-1]
+    edge_u = node_index[:-1][same_segment]
+    edge_v = node_index[1:][same_segment]
+    
+    # remove zero-length edges and duplicates (i.e. overlapping segments)
+    proper = edge_u != edge_v
+    edge_u, edge_v = edge_u[proper], edge_v[proper]
+    edge_keys = np.unique(np.minimum(edge_u, edge_v) * len(nodes) +
+                          np.maximum(edge_u, edge_v))
+    edge_u, edge_v = edge_keys // len(nodes), edge_keys % len(nodes)
+    
+    terminal = None
+    if fixed is not None:
+        terminal = _isin_rows(nodes, np.asarray(fixed, dtype=float).reshape(-1, 2))
+    chains = [chain for chain, _ 
+              in _merge_chains(edge_u, edge_v, len(nodes), terminal)]
+    merged_offsets = np.zeros(len(chains) + 1, dtype=np.int64)
+    merged_offsets[1:] = np.cumsum([len(chain) for chain in chains])
+    if chains:
+        merged_coords = nodes[np.concatenate(chains)]
+    else:
+        merged_coords = np.zeros((0, 2))
+    return merged_coords, merged_offsets
+
+
+def node_and_merge_coords(coords, offsets, tolerance=None, fixed=None):
+    """Split packed lines at all intersections and merge degree-2 chains.
+    
+    Array version of node_and_merge: input and output are packed line 
+    coordinates as returned by pack_lines.
+    
+    Args:
+        coords: float array of shape (N, 2)
+        offsets: integer array of line start indices into coords, plus N
+        tolerance: optional distance below which nodes are merged (default:
+                   1e-9 times the extent of coords)
+        fixed: optional array of shape (K, 2) of points at which lines are 
+               never merged
+        
+    Returns:
+        Tuple (coords, offsets) of the noded and merged lines
+    """
+    coords = np.asarray(coords, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts, ends = _line_segments(coords, offsets)
+    if len(starts) == 0:
+        return np.zeros((0, 2)), np.zeros(1, dtype=np.int64)
+    
+    # find split points on all pairs of segments with overlapping bounds
+    i, j = grid_candidate_pairs(_segment_bounds(starts, ends))
+    splits = _segment_split_points(starts, ends, i, j)
+    return _merge_split_segments(coords, starts, ends, splits, tolerance, 
+                                 fixed)
+
+
+def node_and_merge(lines, tolerance=None):
+    """Split lines at all intersections and merge them between junctions.
+    
+    Produces the same line network as one_linestring_per_intersection, i.e. 
+    LineStrings that start and end only at crossings, junctions and dead 
+    ends, but works on packed coordinate arrays instead of intersecting the 
+    whole network with its bounding box. Candidate segment pairs are found 
+    with a uniform grid, so runtime grows roughly linear with network size.
+    
+    Args:
+        lines: a list of LineStrings or a MultiLineString
+        tolerance: optional distance below which nodes are merged (default:
+                   1e-9 times the extent of the network)
+        
+    Returns:
+        a list of LineStrings
+    """
+    coords, offsets = pack_lines(lines)
+    return unpack_lines(*node_and_merge_coords(coords, offsets, tolerance))
+
+
+def _grid_cell(points, origin, cell_size):
+    """Return integer grid cell indices (ix, iy) of points."""
+    return np.floor((points - origin) / cell_size).astype(np.int64)
+
+
+def _cell_split_points(args):
+    """Pool worker for node_and_merge_grid: split points of some cells.
+    
+    Only pairs of segments whose bounds overlap with their lower left corner
+    in one of the given cells are tested, so that each pair is tested in 
+    exactly one of the cells it shares.
+    """
+    starts, ends, segment_ids, origin, cell_size, cells, num_rows = args
+    # cells: sorted ids (ix * num_rows + iy) of the cells of this task
+    bounds = _segment_bounds(starts, ends)
+    i, j = grid_candidate_pairs(bounds)
+    corner = _grid_cell(np.maximum(bounds[i, :2], bounds[j, :2]), 
+                        origin, cell_size)
+    corner_cell = corner[:, 0] * num_rows + corner[:, 1]
+    position = np.minimum(np.searchsorted(cells, corner_cell), len(cells) - 1)
+    owned = cells[position] == corner_cell
+    segment, t, points = _segment_split_points(starts, ends, 
+                                               i[owned], j[owned])
+    return segment_ids[segment], t, points
+
+
+def node_and_merge_grid(lines, cell_size, workers=1, tolerance=None, 
+                        chunksize=10000):
+    """Grid-partitioned version of node_and_merge.
+    
+    Segments are distributed to all cells of a grid with given cell size 
+    that their bounds overlap. The intersections are computed per cell 
+    (optionally in parallel), each pair of segments in exactly one cell. 
+    The split points of all cells are then joined into one graph, which is 
+    merged to lines exactly like in node_and_merge, so the result is 
+    identical to that of node_and_merge. Only the pairwise segment tests, 
+    which dominate runtime and memory, are partitioned.
+    
+    Args:
+        lines: a list of LineStrings or a MultiLineString
+        cell_size: edge length of the square grid cells
+        workers: optional number of processes (default: 1, no pool)
+        tolerance: optional distance below which nodes are merged (default:
+                   1e-9 times the extent of the network)
+        chunksize: optional minimum number of segments per task; cells 
+                   with fewer segments are processed together with their 
+                   neighbors
+    
+    Returns:
+        a list of LineStrings
+    """
+    coords, offsets = pack_lines(lines)
+    starts, ends = _line_segments(coords, offsets)
+    if len(starts) == 0:
+        return []
+    
+    # one entry per (segment, covered cell)
+    bounds = _segment_bounds(starts, ends)
+    origin = bounds[:, :2].min(axis=0)
+    low = _grid_cell(bounds[:, :2], origin, cell_size)
+    high = _grid_cell(bounds[:, 2:], origin, cell_size)
+    nx = high[:, 0] - low[:, 0] + 1
+    cells_per_segment = nx * (high[:, 1] - low[:, 1] + 1)
+    segment = np.repeat(np.arange(len(starts)), cells_per_segment)
+    k = _ragged_arange(cells_per_segment)
+    num_rows = high[:, 1].max() + 1
+    cell = ((low[segment, 0] + k % nx[segment]) * num_rows + 
+            low[segment, 1] + k // nx[segment])
+    
+    # one task per cell, or per run of neighboring cells with few segments
+    order = np.argsort(cell, kind='mergesort')
+    segment, cell = segment[order], cell[order]
+    cell_starts = np.append(0, np.nonzero(np.diff(cell))[0] + 1)
+    task_starts = [0]
+    for cell_start in cell_starts[1:].tolist():
+        if cell_start - task_starts[-1] >= chunksize:
+            task_starts.append(cell_start)
+    tasks = []
+    for start, end in pairs(task_starts + [len(cell)]):
+        ids = np.unique(segment[start:end])
+        tasks.append((starts[ids], ends[ids], ids, origin, cell_size, 
+                      np.unique(cell[start:end]), num_rows))
+    
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_cell_split_points, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_cell_split_points(task) for task in tasks]
+    
+    splits = tuple(np.concatenate(parts) for parts in zip(*results))
+    return unpack_lines(*_merge_split_segments(coords, starts, ends, splits,
+                                               tolerance))
+
+
+def iter_linemerge(geometries, sorted_by_x=False):
+    """Merge a stream of LineStrings and/or MultiLineStrings incrementally.
+    
+    Streaming version of linemerge that accepts any iterable (e.g. a chunked
+    shapefile reader) and yields merged LineStrings as soon as they are 
+    final. Lines are joined at points where exactly two line ends meet. An 
+    endpoint is closed, i.e. known to be final, once three or more line ends 
+    meet there, or once no line to come can touch it anymore.
+    
+    Without further knowledge about the input, the latter is only known when
+    the input is exhausted. If sorted_by_x is set, geometries must arrive 
+    ordered by their minimum x coordinate (bounds[0]); then all endpoints 
+    left of the current geometry are closed and merged lines start flowing 
+    while input is still read. Memory then stays proportional to the open 
+    lines crossing the current sweep position.
+    
+    Args:
+        geometries: iterable of LineStrings and/or MultiLineStrings
+        sorted_by_x: optional (default: False) promise that geometries are
+                     ordered by their minimum x coordinate
+    
+    Yields:
+        merged LineStrings (in no particular order)
+    
+    Raises:
+        ValueError if sorted_by_x is set, but geometries are not sorted
+    """
+    lines = {}           # line id -> deque of coordinate tuples
+    incident = {}        # endpoint -> list of open line ids ending there
+    degree = {}          # endpoint -> number of line ends ever seen there
+    closed = set()       # endpoints that no further line can touch
+    open_heap = []       # (x, endpoint) of open endpoints for sorted_by_x
+    finished = []        # merged lines ready to be yielded
+    line_ids = itertools.count()
+    
+    def is_settled(point):
+        return point in closed or degree[point] >= 3
+    
+    def forget(point, line_id):
+        incident[point].remove(line_id)
+        if not incident[point] and point in closed:
+            del incident[point]
+            del degree[point]
+            closed.discard(point)
+    
+    def try_finish(line_id):
+        coords = lines.get(line_id)
+        if coords is None:
+            return
+        if is_settled(coords[0]) and is_settled(coords[-1]):
+            del lines[line_id]
+            forget(coords[0], line_id)
+            forget(coords[-1], line_id)
+            finished.append(LineString(coords))
+    
+    def join(point):
+        # merge the two distinct lines ending at point into the longer one
+        a, b = incident[point]
+        if len(lines[a]) < len(lines[b]):
+            a, b = b, a
+        longer, shorter = lines[a], list(lines.pop(b))
+        if shorter[0] != point:
+            shorter.reverse()
+        # now shorter starts at point; attach it where longer ends at point
+        if longer[-1] == point:
+            longer.extend(shorter[1:])
+        else:
+            longer.extendleft(shorter[1:])
+        far_end = shorter[-1]
+        incident[far_end][incident[far_end].index(b)] = a
+        del incident[point]
+        del degree[point]
+        closed.discard(point)
+        return a
+    
+    def close(point):
+        if point in closed or point not in incident:
+            return
+        closed.add(point)
+        line_ids_here = incident[point]
+        if degree[point] == 2 and line_ids_here[0] != line_ids_here[1]:
+            try_finish(join(point))
+        else:
+            for line_id in list(line_ids_here):
+                try_finish(line_id)
+    
+    def add(line):
+        if line.length == 0:
+            return # like linemerge, ignore degenerate lines
+        coords = collections.deque()
+        for c in line.coords:
+            if not coords or coords[-1] != tuple(c):
+                coords.append(tuple(c)) # skip repeated points
+        line_id = next(line_ids)
+        lines[line_id] = coords
+        for point in (coords[0], coords[-1]):
+            if point not in incident:
+                incident[point] = []
+                degree[point] = 0
+                if sorted_by_x:
+                    heapq.heappush(open_heap, (point[0], point))
+            incident[point].append(line_id)
+            degree[point] += 1
+        for point in (coords[0], coords[-1]):
+            if degree[point] == 3:
+                # point just became a junction, lines ending here are final 
+                # at this end
+                for other_id in list(incident[point]):
+                    try_finish(other_id)
+        try_finish(line_id)
+    
+    sweep_x = None
+    for geometry in geometries:
+        if sorted_by_x:
+            min_x = geometry.bounds[0]
+            if sweep_x is not None and min_x < sweep_x:
+                raise ValueError('geometries are not sorted by minimum x.')
+            sweep_x = min_x
+            while open_heap and open_heap[0][0] < sweep_x:
+                close(heapq.heappop(open_heap)[1])
+        
+        if isinstance(geometry, MultiLineString):
+            for line in geometry.geoms:
+                add(line)
+        else:
+            add(geometry)
+        
+        while finished:
+            yield finished.pop()
+    
+    # input exhausted: all remaining endpoints are closed
+    for point in list(incident.keys()):
+        close(point)
+    while finished:
+        yield finished.pop()
+
+
+instrumentation.register(__name__)
@@ -1,7 +1,13 @@
+import datetime
 import itertools
-import shapefile
-from shapely.geometry import Polygon, MultiLineString, LineString, Point
-import pdb
+import struct
+from lazyimports import lazy_import
+
+# heavy dependencies are only imported when first used
+pandashp = lazy_import('pandashp')
+shapefile = lazy_import('shapefile')
+shapelytools = lazy_import('shapelytools')
+shapely_geometry = lazy_import('shapely.geometry')
 
 def read_shp(filename):
     """Read contents of a shapefile to a shapely geometry object.
@@ -22,7 +28,7 @@ def read_shp(filename):
 
     if sr.shapeType == shapefile.POLYGON:
         shapes = sr.shapes()
-        geometries = [Polygon(shape.points) for shape in shapes]
+        geometries = [shapely_geometry.Polygon(shape.points) for shape in shapes]
         
         fields = sr.fields[:]
         if fields[0][0] == 'DeletionFlag':
@@ -43,7 +49,7 @@ def read_shp(filename):
 
     elif sr.shapeType == shapefile.POLYLINE:
         shapes = sr.shapes()
-        geometries = [LineString(shape.points) for shape in shapes]
+        geometries = [shapely_geometry.LineString(shape.points) for shape in shapes]
 
         fields = sr.fields[:] # [:] = duplicate field list
         if fields[0][0] == 'DeletionFlag':
@@ -73,7 +79,8 @@ def read_shp(filename):
 
 
 
-def write_shp(filename, geometry, records=[], fields=[]):
+def write_shp(filename, geometry, records=[], fields=[], curve=None,
+              spatial_index=False):
     """Write a single shapely MultiLineString or Polygon to a shapefile.
 
     Argument geometry may also be a list of LineString objects. In that case,
@@ -83,16 +90,33 @@ def write_shp(filename, geometry, records=[], fields=[]):
 
     Usage:
         write_shp(filename, geometry, records=[], fields=[])
+        write_shp(filename, geometry, curve='hilbert', spatial_index=True)
 
     Arguments:
         filename    filename of shapefile
         geometry    a shapely geometry (MultiLineString, Polygon, ...)
         records     optional list of list of values, one per geometry
         fields      optional (implied by records) list of fieldnames
+        curve       optional 'hilbert' or 'zorder' to write the features
+                    sorted along a space-filling curve
+        spatial_index  optional; if True, write a spatial index file
+                    (see pandashp.write_spatial_index)
     """
 
+    # sort features along space-filling curve
+    if curve is not None and isinstance(geometry, list):
+        order = shapelytools.curve_order([g.bounds for g in geometry], curve)
+        geometry = [geometry[i] for i in order]
+        if records:
+            records = [records[i] for i in order]
+    elif curve is not None and isinstance(geometry,
+                                          shapely_geometry.MultiLineString):
+        lines = list(geometry.geoms)
+        order = shapelytools.curve_order([g.bounds for g in lines], curve)
+        geometry = shapely_geometry.MultiLineString([lines[i] for i in order])
+
     # SINGLE MULTILINESTRING
-    if isinstance(geometry, MultiLineString):
+    if isinstance(geometry, shapely_geometry.MultiLineString):
         sw = shapefile.Writer(shapefile.POLYLINE)
 
         # fields
@@ -104,7 +128,7 @@ def write_shp(filename, geometry, records=[], fields=[]):
         sw.field("npoints")
 
         # geometry and record
-        for line in geometry:
+        for line in geometry.geoms:
             sw.line([list(line.coords)])
             sw.record(line.length,
                       line.coords[0][0],
@@ -115,7 +139,7 @@ def write_shp(filename, geometry, records=[], fields=[]):
         sw.save(filename)
 
     # SINGLE POLYGON
-    elif isinstance(geometry, Polygon):
+    elif isinstance(geometry, shapely_geometry.Polygon):
         # data
         parts = [list(geometry.exterior.coords)]
         parts.extend(list(interior.coords) for interior in geometry.interiors)
@@ -152,7 +176,7 @@ def write_shp(filename, geometry, records=[], fields=[]):
 
 
         # LIST OF LINESTRINGS
-        if isinstance(geometry[0], LineString):
+        if isinstance(geometry[0], shapely_geometry.LineString):
             sw = shapefile.Writer(shapefile.POLYLINE)
 
             # fields
@@ -172,7 +196,7 @@ def write_shp(filename, geometry, records=[], fields=[]):
             sw.save(filename)
 
         # LIST OF POLYGONS
-        elif isinstance(geometry[0], Polygon):
+        elif isinstance(geometry[0], shapely_geometry.Polygon):
             sw = shapefile.Writer(shapefile.POLYGON)
             
             # fields
@@ -187,7 +211,7 @@ def write_shp(filename, geometry, records=[], fields=[]):
             sw.save(filename)
         
         # LIST OF POINTS
-        elif isinstance(geometry[0], Point):
+        elif isinstance(geometry[0], shapely_geometry.Point):
             sw = shapefile.Writer(shapefile.POINT)
             
             # fields
@@ -215,4 +239,238 @@ def write_shp(filename, geometry, records=[], fields=[]):
     else:
         raise NotImplementedError
 
+    if spatial_index:
+        if isinstance(geometry, shapely_geometry.Polygon):
+            geometry = [geometry]
+        elif isinstance(geometry, shapely_geometry.MultiLineString):
+            geometry = geometry.geoms
+        pandashp.write_spatial_index(filename, [g.bounds for g in geometry])
+    else:
+        pandashp.remove_spatial_index(filename)
+
+
+# shape types, identical to pyshp's constants
+POINT = 1
+POLYLINE = 3
+POLYGON = 5
+
+# default dbf field sizes by field type
+_FIELD_SIZES = {'C': 50, 'N': 18, 'F': 18, 'L': 1, 'D': 8}
+
+
+class ShapefileWriter(object):
+    """Write features to a shapefile one at a time, in constant memory.
+
+    In contrast to write_shp, the fields must be declared in advance. Each
+    feature is written to the .shp, .shx and .dbf files as soon as it is
+    added; the file headers (length, bounding box, number of records) are
+    completed by close().
+
+    Usage:
+        fields = [('length', 'N', 18, 5), ('name', 'C', 30)]
+        with ShapefileWriter('roads', POLYLINE, fields) as sw:
+            for line in line_generator():
+                sw.write(line, [line.length, 'road'])
+        # or, for an iterable of (geometry, record) tuples
+        with ShapefileWriter('roads', POLYLINE, fields) as sw:
+            sw.write_many(feature_generator())
 
+    Arguments:
+        filename    filename of shapefile (without .shp extension)
+        shape_type  POINT, POLYLINE or POLYGON
+        fields      list of field tuples (name, type[, size[, decimal]]);
+                    type is one of 'C' (string), 'N' or 'F' (numeric),
+                    'L' (logical) or 'D' (date)
+        encoding    optional encoding of strings in the .dbf
+    """
+
+    def __init__(self, filename, shape_type, fields, encoding='utf-8'):
+        if shape_type not in (POINT, POLYLINE, POLYGON):
+            raise ValueError('Unsupported shape type {}.'.format(shape_type))
+
+        self.filename = filename
+        self.shape_type = shape_type
+        self.fields = [_field_spec(field) for field in fields]
+        self.encoding = encoding
+        self.num_records = 0
+        self.bbox = None
+
+        self._shp = open(filename + '.shp', 'wb')
+        self._shx = open(filename + '.shx', 'wb')
+        self._dbf = open(filename + '.dbf', 'wb')
+
+        # placeholder headers, completed by close()
+        self._shp.write(b'\0' * 100)
+        self._shx.write(b'\0' * 100)
+        self._offset = 100
+        self._write_dbf_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, geometry, record=()):
+        """Write a single feature.
+
+        Arguments:
+            geometry    a shapely Point, (Multi)LineString or (Multi)Polygon
+                        matching the shape type
+            record      list of values, one per declared field
+        """
+        if len(record) != len(self.fields):
+            raise ValueError('Record has {} values, but {} fields are '
+                             'declared.'.format(len(record), len(self.fields)))
+
+        content = self._shape_content(geometry)
+        self.num_records += 1
+        self._shp.write(struct.pack('>2i', self.num_records, len(content) // 2))
+        self._shp.write(content)
+        self._shx.write(struct.pack('>2i', self._offset // 2, len(content) // 2))
+        self._offset += 8 + len(content)
+        self._dbf.write(b' ' + b''.join(self._dbf_value(value, field)
+                        for value, field in zip(record, self.fields)))
+
+    def write_many(self, features):
+        """Write all (geometry, record) tuples of an iterable, e.g. a generator.
+
+        Arguments:
+            features    iterable of (geometry, record) tuples
+        """
+        for geometry, record in features:
+            self.write(geometry, record)
+
+    def close(self):
+        """Complete file headers and close all files."""
+        if self._shp.closed:
+            return
+
+        bbox = self.bbox or (0.0, 0.0, 0.0, 0.0)
+        shx_length = 100 + 8 * self.num_records
+        for f, length in ((self._shp, self._offset), (self._shx, shx_length)):
+            f.seek(0)
+            f.write(struct.pack('>7i', 9994, 0, 0, 0, 0, 0, length // 2))
+            f.write(struct.pack('<2i', 1000, self.shape_type))
+            f.write(struct.pack('<8d', *(tuple(bbox) + (0.0,) * 4)))
+            f.close()
+
+        self._dbf.write(b'\x1a') # end of file marker
+        self._dbf.seek(4)
+        self._dbf.write(struct.pack('<I', self.num_records))
+        self._dbf.close()
+
+    def _write_dbf_header(self):
+        """Write dbf header and field descriptors (record count is patched)."""
+        today = datetime.date.today()
+        header_length = 32 + 32 * len(self.fields) + 1
+        record_length = 1 + sum(size for _, _, size, _ in self.fields)
+        self._dbf.write(struct.pack('<4BIHH20x', 3, today.year - 1900,
+                                    today.month, today.day, 0,
+                                    header_length, record_length))
+        for name, field_type, size, decimal in self.fields:
+            name = _encode(name, 'ascii')[:10]
+            self._dbf.write(struct.pack('<11sc4xBB14x', name,
+                                        field_type.encode('ascii'),
+                                        size, decimal))
+        self._dbf.write(b'\r') # end of field descriptors
+
+    def _shape_content(self, geometry):
+        """Return binary shape record content of geometry, update bbox."""
+        minx, miny, maxx, maxy = geometry.bounds
+        if self.bbox is None:
+            self.bbox = [minx, miny, maxx, maxy]
+        else:
+            self.bbox = [min(self.bbox[0], minx), min(self.bbox[1], miny),
+                         max(self.bbox[2], maxx), max(self.bbox[3], maxy)]
+
+        if self.shape_type == POINT:
+            if geometry.geom_type != 'Point':
+                raise ValueError('Expected Point, got {}.'.format(
+                                 geometry.geom_type))
+            return struct.pack('<i2d', POINT, geometry.x, geometry.y)
+
+        if self.shape_type == POLYLINE:
+            if geometry.geom_type == 'LineString':
+                parts = [list(geometry.coords)]
+            elif geometry.geom_type == 'MultiLineString':
+                parts = [list(line.coords) for line in geometry.geoms]
+            else:
+                raise ValueError('Expected (Multi)LineString, got {}.'.format(
+                                 geometry.geom_type))
+        else:
+            if geometry.geom_type == 'Polygon':
+                polygons = [geometry]
+            elif geometry.geom_type == 'MultiPolygon':
+                polygons = list(geometry.geoms)
+            else:
+                raise ValueError('Expected (Multi)Polygon, got {}.'.format(
+                                 geometry.geom_type))
+            # shapefiles expect clockwise outer rings and counter-clockwise
+            # holes
+            parts = []
+            for polygon in polygons:
+                parts.append(_oriented(polygon.exterior.coords, clockwise=True))
+                parts.extend(_oriented(interior.coords, clockwise=False)
+                             for interior in polygon.interiors)
+
+        starts = [0]
+        for part in parts[:-1]:
+            starts.append(starts[-1] + len(part))
+        points = [c for part in parts for point in part for c in point[:2]]
+        return (struct.pack('<i4d2i', self.shape_type, minx, miny, maxx, maxy,
+                            len(parts), len(points) // 2) +
+                struct.pack('<{}i'.format(len(starts)), *starts) +
+                struct.pack('<{}d'.format(len(points)), *points))
+
+    def _dbf_value(self, value, field):
+        """Return value formatted as fixed-width dbf field content."""
+        name, field_type, size, decimal = field
+        if value is None:
+            return b' ' * size
+
+        if field_type in 'NF':
+            if decimal:
+                text = '{:.{}f}'.format(float(value), decimal)
+            else:
+                text = '{:d}'.format(int(value))
+            if len(text) > size:
+                raise ValueError("Value {} too wide for field '{}'.".format(
+                                 value, name))
+            return text.rjust(size).encode('ascii')
+        elif field_type == 'L':
+            return b'T' if value else b'F'
+        elif field_type == 'D':
+            return _encode(value.strftime('%Y%m%d') if hasattr(value, 'strftime')
+                           else value, 'ascii')[:size].ljust(size)
+        else:
+            return _encode(value, self.encoding)[:size].ljust(size)
+
+
+def _field_spec(field):
+    """Return field tuple (name, type, size, decimal) with defaults."""
+    name, field_type = field[0], field[1] if len(field) > 1 else 'C'
+    if field_type not in _FIELD_SIZES:
+        raise ValueError("Unknown field type '{}'.".format(field_type))
+    size = int(field[2]) if len(field) > 2 else _FIELD_SIZES[field_type]
+    decimal = int(field[3]) if len(field) > 3 else 0
+    return (name, field_type, size, decimal)
+
+
+def _encode(value, encoding):
+    """Return value as bytes, converting non-strings to their text first."""
+    if isinstance(value, bytes):
+        return value
+    return u'{}'.format(value).encode(encoding)
+
+
+def _oriented(coords, clockwise):
+    """Return list of ring coordinates in the requested orientation."""
+    coords = list(coords)
+    # shoelace formula: positive area means counter-clockwise
+    area = sum(x0 * y1 - x1 * y0
+               for (x0, y0), (x1, y1) in zip(
+                   [c[:2] for c in coords[:-1]], [c[:2] for c in coords[1:]]))
+    if (area < 0) != clockwise:
+        coords.reverse()
+    return coords
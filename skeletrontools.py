@@ -1,33 +1,187 @@
-from shapely.geometry import Polygon, LineString, Point, box
+from lazyimports import lazy_import
+import hashlib
+import os
+import pickle
+import sys
+import time
 
-import Skeletron
-import pandashp
-import shapely.ops
+try:
+    import resource
+except ImportError: # resource is only available on Unix platforms
+    resource = None
+
+# heavy dependencies are only imported when first used
+Skeletron = lazy_import('Skeletron')
+shapelytools = lazy_import('shapelytools')
+shapely_geometry = lazy_import('shapely.geometry')
+shapely_ops = lazy_import('shapely.ops')
 
 def select_biggest_polygon_from_multipolygon(multi_polygon):
     """Return the polygon with the biggest exterior length from a multipolygon."""
-    if isinstance(multi_polygon, Polygon):
+    if isinstance(multi_polygon, shapely_geometry.Polygon):
         return multi_polygon
 
-    component_lengths = [poly.exterior.length for poly in multi_polygon]
+    polygons = list(multi_polygon.geoms)
+    component_lengths = [poly.exterior.length for poly in polygons]
     biggest_component_index = component_lengths.index(max(component_lengths))
-    return multi_polygon[biggest_component_index]
+    return polygons[biggest_component_index]
 
 
 def extract_lines_from_graph(graphs):
-    lines = []
-    for graph in graphs:
-        for line_dict in graph.edge.values():
-            if line_dict:
-                for k in line_dict.keys():
-                    lines.append(line_dict[k]['line'])
-    return lines
+    """Return list of edge LineStrings (attribute 'line') from graphs.
+    
+    Each undirected edge is returned once, not once per adjacency entry.
+    """
+    return [data['line'] 
+            for graph in graphs 
+            for _, _, data in graph.edges(data=True)]
+
+
+def geometry_complexity(geometry):
+    """Count parts and vertices of a geometry or a list of geometries.
+    
+    Args:
+        geometry: a shapely geometry (single or multi-part) or a list of them
+        
+    Returns:
+        Tuple (parts, vertices) with the number of single-part geometries and
+        the total number of coordinate tuples in them
+    """
+    if isinstance(geometry, (list, tuple)):
+        parts, vertices = 0, 0
+        for geom in geometry:
+            p, v = geometry_complexity(geom)
+            parts += p
+            vertices += v
+        return parts, vertices
+    
+    if hasattr(geometry, 'geoms'):
+        # multi-part geometry or collection
+        return geometry_complexity(list(geometry.geoms))
+    
+    if isinstance(geometry, shapely_geometry.Polygon):
+        vertices = len(geometry.exterior.coords)
+        vertices += sum(len(ring.coords) for ring in geometry.interiors)
+        return 1, vertices
+    
+    return 1, len(geometry.coords)
+
+
+def _peak_memory():
+    """Return peak resident memory of this process in MB (None if unknown)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kB on Linux, but in bytes on Mac OS X
+    return peak / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+
+def _start_stage():
+    """Return tuple (time, peak memory) marking the start of a stage."""
+    return time.time(), _peak_memory()
+
+
+def _record_stage(report, callback, stage, started, before, after, 
+                  cached=False):
+    """Append timing, memory and complexity of a finished stage to report.
+    
+    Does nothing if profiling is disabled (report is None). Argument cached
+    marks stages whose result was loaded from the cache of skeletonize.
+    
+    As the peak memory is a high-water mark of the whole process, only its
+    increase during a stage (memory_increase) can be attributed to it; 
+    stages that stay below an earlier peak have an increase of 0.
+    
+    Returns:
+        _start_stage() after recording, to be used as start of the next stage
+    """
+    if report is None:
+        return started
+    
+    start_time, memory_before = started
+    seconds = time.time() - start_time
+    peak_memory = _peak_memory()
+    memory_increase = None
+    if peak_memory is not None:
+        memory_increase = peak_memory - memory_before
+    parts_before, vertices_before = geometry_complexity(before)
+    parts_after, vertices_after = geometry_complexity(after)
+    
+    stats = {
+        'stage': stage,
+        'seconds': seconds,
+        'peak_memory': peak_memory,
+        'memory_increase': memory_increase,
+        'parts_before': parts_before,
+        'vertices_before': vertices_before,
+        'parts_after': parts_after,
+        'vertices_after': vertices_after,
+        'cached': cached}
+    report.append(stats)
+    
+    if callback is not None:
+        callback(stats)
+    
+    # restart clock only now to exclude complexity counting from next stage
+    return _start_stage()
+
+
+def hash_geometries(geometries):
+    """Return a hex digest identifying a list of geometries by their WKB."""
+    digest = hashlib.sha1()
+    for geom in geometries:
+        digest.update(geom.wkb)
+    return digest.hexdigest()
+
+
+def _cache_key(parent_key, stage, *parameters):
+    """Derive the key of a stage from its predecessor's key and parameters."""
+    token = repr((parent_key, stage) + parameters).encode('utf-8')
+    return hashlib.sha1(token).hexdigest()
+
+
+def _cache_get(cache, key):
+    """Return cached object for key, or None if missing or cache is None."""
+    if cache is None:
+        return None
+    
+    if isinstance(cache, str):
+        filename = os.path.join(cache, key + '.pickle')
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    
+    return cache.get(key)
+
+
+def _cache_put(cache, key, value):
+    """Store value under key in a cache directory or dict-like cache."""
+    if cache is None:
+        return
+    
+    if isinstance(cache, str):
+        if not os.path.isdir(cache):
+            os.makedirs(cache)
+        filename = os.path.join(cache, key + '.pickle')
+        # write to temporary file first, so that aborted runs leave no
+        # truncated cache entries behind
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(filename + '.tmp', filename)
+    else:
+        cache[key] = value
+
 
 def skeletonize(roads, buffer_length=60,
                        dissolve_length=30,
                        simplify_length=30,
                        buffer_resolution=2,
-                       psg_length=150):
+                       psg_length=150,
+                       profile=False,
+                       cache=None):
     """Uses qhull to find simplified road network for given DataFrame of roads.
     
     Args:
@@ -37,37 +191,109 @@ def skeletonize(roads, buffer_length=60,
         simplify_length     optional 
         buffer_resolution   optional
         psg_length          optional (default: 150) Skeletron algorithm length
+        profile             optional (default: False) if True, return tuple
+                            (streets, report) with report being a list of 
+                            dicts (one per stage) with keys stage, seconds, 
+                            peak_memory (of the process so far, in MB), 
+                            memory_increase (of the peak during the stage,
+                            in MB), parts/vertices_before/after and cached;
+                            if a callable, it is called with each stage's 
+                            dict
+        cache               optional (default: None) directory name or dict-
+                            like object to store intermediate results in;
+                            the merged buffer, the biggest dissolved
+                            component and the skeleton lines are keyed on
+                            the input roads and all parameters used up to
+                            that stage, so parameter sweeps only recompute
+                            the stages downstream of a changed parameter
     """
+    if callable(profile):
+        report, callback = [], profile
+    elif profile:
+        report, callback = [], None
+    else:
+        report, callback = None, None
+    started = _start_stage()
 
     # buffer and merge streets
-    streets_buffered = [way['geometry'].buffer(buffer_length, buffer_resolution) 
-                                              for _, way in roads.iterrows()]
-    streets_buffered_merged = shapely.ops.cascaded_union(streets_buffered)
-
-    # the union now has several connected components
-    # select the component with the longest circumference (=exterior.length)
-    # and undo the buffer operation and repeat the selection process
-    streets_buffered_merged = select_biggest_polygon_from_multipolygon(streets_buffered_merged)
-    streets_buffered_merged = streets_buffered_merged.buffer(-dissolve_length)
-    streets_buffered_merged = select_biggest_polygon_from_multipolygon(streets_buffered_merged)
-    streets_buffered_merged_simplified = streets_buffered_merged.simplify(simplify_length)
-
-    # then calculate skeleton (expensive but necessary)
-    street_graphs = Skeletron.polygon_skeleton_graphs(streets_buffered_merged_simplified,psg_length)
-    street_lines = extract_lines_from_graph(street_graphs)
-
-    # merge list of lines to MultiLine
-    street_lines_merged = shapely.ops.linemerge(street_lines)
-
-    # intersecting multiline with its bounding box somehow triggers a first
-    whole_city = box(*street_lines_merged.bounds)
-
-    # perform linemerge (one linestring between each crossing only)
-    # if this fails, write function to perform this on a bbox-grid and then
-    # merge the result
-    street_lines_merged_intersect = street_lines_merged.intersection(whole_city)
-    street_lines_merged_intersect_merged = shapely.ops.linemerge(street_lines_merged_intersect)
+    road_lines = list(roads['geometry'])
+    if cache is not None:
+        buffer_key = _cache_key(hash_geometries(road_lines), 'buffer',
+                                buffer_length, buffer_resolution)
+        dissolve_key = _cache_key(buffer_key, 'dissolve', dissolve_length)
+        skeleton_key = _cache_key(dissolve_key, 'skeleton', 
+                                  simplify_length, psg_length)
+    else:
+        buffer_key, dissolve_key, skeleton_key = None, None, None
+    
+    street_lines = _cache_get(cache, skeleton_key)
+    if street_lines is not None:
+        started = _record_stage(report, callback, 'skeleton', started,
+                                road_lines, street_lines, cached=True)
+    else:
+        streets_dissolved_biggest = _cache_get(cache, dissolve_key)
+        if streets_dissolved_biggest is not None:
+            started = _record_stage(report, callback, 
+                                    'select_component_dissolved', started,
+                                    road_lines, streets_dissolved_biggest, 
+                                    cached=True)
+        else:
+            streets_buffered_merged = _cache_get(cache, buffer_key)
+            if streets_buffered_merged is not None:
+                started = _record_stage(report, callback, 'union', started,
+                                        road_lines, streets_buffered_merged,
+                                        cached=True)
+            else:
+                streets_buffered = [way.buffer(buffer_length, buffer_resolution) 
+                                    for way in road_lines]
+                started = _record_stage(report, callback, 'buffer', started,
+                                        road_lines, streets_buffered)
+                
+                streets_buffered_merged = shapely_ops.unary_union(streets_buffered)
+                started = _record_stage(report, callback, 'union', started,
+                                        streets_buffered, streets_buffered_merged)
+                _cache_put(cache, buffer_key, streets_buffered_merged)
+        
+            # the union now has several connected components
+            # select the component with the longest circumference (=exterior.length)
+            # and undo the buffer operation and repeat the selection process
+            streets_biggest = select_biggest_polygon_from_multipolygon(streets_buffered_merged)
+            started = _record_stage(report, callback, 'select_component', started,
+                                    streets_buffered_merged, streets_biggest)
+            
+            streets_dissolved = streets_biggest.buffer(-dissolve_length)
+            started = _record_stage(report, callback, 'negative_buffer', started,
+                                    streets_biggest, streets_dissolved)
+            
+            streets_dissolved_biggest = select_biggest_polygon_from_multipolygon(streets_dissolved)
+            started = _record_stage(report, callback, 'select_component_dissolved', 
+                                    started, streets_dissolved, 
+                                    streets_dissolved_biggest)
+            _cache_put(cache, dissolve_key, streets_dissolved_biggest)
+        
+        streets_buffered_merged_simplified = streets_dissolved_biggest.simplify(simplify_length)
+        started = _record_stage(report, callback, 'simplify_polygon', started,
+                                streets_dissolved_biggest,
+                                streets_buffered_merged_simplified)
+    
+        # then calculate skeleton (expensive but necessary)
+        street_graphs = Skeletron.polygon_skeleton_graphs(streets_buffered_merged_simplified,psg_length)
+        street_lines = extract_lines_from_graph(street_graphs)
+        started = _record_stage(report, callback, 'skeleton', started,
+                                streets_buffered_merged_simplified, street_lines)
+        _cache_put(cache, skeleton_key, street_lines)
+
+    # split lines at crossings and merge them between crossings, so that
+    # there is one linestring between each crossing only
+    street_lines_noded = shapelytools.node_and_merge(street_lines)
+    started = _record_stage(report, callback, 'node_and_merge', started,
+                            street_lines, street_lines_noded)
 
     # and remove zigzaging (for smoother plots)
-    streets = street_lines_merged_intersect_merged.simplify(simplify_length)
-    return streets
\ No newline at end of file
+    streets = shapely_geometry.MultiLineString(street_lines_noded).simplify(simplify_length)
+    started = _record_stage(report, callback, 'simplify_lines', started,
+                            street_lines_noded, streets)
+    
+    if report is not None and callback is None:
+        return streets, report
+    return streets